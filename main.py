@@ -1,4 +1,9 @@
-from src.app import main
+import sys
 
 if __name__ == "__main__":
-    main()
+    if "--profile-startup" in sys.argv[1:]:
+        from src.profiling import profile_startup
+        profile_startup(json_output="--json" in sys.argv[1:])
+    else:
+        from src.app import main
+        main()
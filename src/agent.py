@@ -0,0 +1,222 @@
+"""Unlock agent: a process that unlocks the vault once and serves other processes of the same user over a Unix
+domain socket, so they do not have to run the KDF themselves.
+
+The protocol is one JSON object per line in both directions. A request names its operation in `op`, a response has
+`ok` and either the result or `error`:
+
+    {"op": "get", "name": "github"}            {"ok": true, "password": "..."}
+    {"op": "ls", "query": "git"}               {"ok": true, "names": ["github"]}
+    {"op": "add", "name": "x", "password": "y"}   {"ok": true}
+    {"op": "generate", "name": "x", "policy": "Default"}   {"ok": true, "password": "..."}
+    {"op": "ping"}, {"op": "lock"}             {"ok": true}
+
+The socket lives in a directory only its owner can enter and connections of other users are refused. After
+`agent_idle_timeout` seconds without a request, or on `lock`, the agent forgets the token and exits."""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+from hashlib import sha256
+from pathlib import Path
+from typing import List, Optional
+
+import src.config as config
+from src.utils import vault_path
+
+
+def default_path(vault: Optional[Path] = None) -> Path:
+    """Socket path of the agent serving `vault`, by default in the user's runtime directory. `agent_socket` from
+    the config replaces the one of the default vault, other vaults get a socket named after their file."""
+    vault = vault_path(vault).resolve()
+    default = vault == vault_path().resolve()
+    if config.agent_socket and default:
+        return Path(config.agent_socket)
+    name = "agent.sock" if default else f"agent-{sha256(bytes(vault)).hexdigest()[:16]}.sock"
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(base) / f"pswdmngr-{os.getuid()}" / name
+
+
+def _private_directory(path: Path) -> None:
+    """Creates the socket directory, or checks that the existing one belongs to us and nobody else can enter it."""
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    info = path.lstat()
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise ValueError(f"Agent directory {path} is not private!")
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of one connection, line by line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be an object!")
+                response = self.server.dispatch(request)
+            except ValueError as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Agent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves an unlocked `PasswordManager`. Every connection has its own thread, reads run in parallel."""
+
+    daemon_threads = True
+
+    def __init__(self, manager, path: Optional[Path] = None, idle_timeout: float = config.agent_idle_timeout):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("The agent needs Unix domain sockets!")
+        self.path = Path(path or default_path(manager.path))
+        _private_directory(self.path.parent)
+        if self.path.exists():
+            if connect(self.path):
+                raise ValueError("Agent is already running!")
+            self.path.unlink()
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), AgentHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+        self.manager = manager
+        self.idle_timeout = idle_timeout
+        self.last_request = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def serve(self) -> None:
+        """Serves until locked or idle for too long, then forgets the token and removes the socket."""
+        watchdog = threading.Thread(target=self._watchdog, daemon=True)
+        watchdog.start()
+        try:
+            self.serve_forever(poll_interval=0.1)
+        finally:
+            self.stopped.set()
+            self.server_close()
+            self.path.unlink(missing_ok=True)
+            self.manager.lock()
+
+    def _watchdog(self) -> None:
+        while not self.stopped.wait(min(self.idle_timeout, 1.0)):
+            if time.monotonic() - self.last_request > self.idle_timeout:
+                self.shutdown()
+                return
+
+    def verify_request(self, request, client_address) -> bool:
+        """Refuses connections of other users where the system tells who is connecting."""
+        if hasattr(socket, "SO_PEERCRED"):
+            credentials = request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+            _, uid, _ = struct.unpack("3i", credentials)
+            return uid == os.getuid()
+        return True
+
+    def dispatch(self, request: dict) -> dict:
+        with self.lock:
+            self.last_request = time.monotonic()
+        op = request.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "lock":
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return {"ok": True}
+        self.manager.refresh()
+        if op == "get":
+            service = self.manager.find_service(_param(request, "name"))
+            if service is None:
+                raise ValueError(f"Service {request['name']} does not exist!")
+            return {"ok": True, "password": service.password}
+        if op == "ls":
+            query = request.get("query")
+            services = self.manager.search(query, config.search_limit) if query else self.manager.services
+            return {"ok": True, "names": [service.name for service in services]}
+        if op == "add":
+            if not self.manager.add_service(_param(request, "name"), password=_param(request, "password")):
+                raise ValueError("Could not store the service!")
+            return {"ok": True}
+        if op == "generate":
+            from src.interface import Policy
+            policy_name = request.get("policy") or config.default_policy_name
+            policy = self.manager.get_policy(policy_name) or Policy(policy_name)
+            service = self.manager.add_service(_param(request, "name"), policy=policy)
+            if not service:
+                raise ValueError("Could not store the service!")
+            return {"ok": True, "password": service.password}
+        raise ValueError(f"Unknown operation {op}!")
+
+
+def _param(request: dict, name: str) -> str:
+    value = request.get(name)
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"Missing parameter {name}!")
+    return value
+
+
+class AgentClient:
+    """Talks to a running agent. Every call opens its own connection, failed requests raise `ValueError`."""
+
+    def __init__(self, path: Optional[Path] = None, timeout: float = config.agent_client_timeout,
+                 vault: Optional[Path] = None):
+        self.path = Path(path or default_path(vault))
+        self.timeout = timeout
+
+    def request(self, op: str, **params) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            connection.connect(str(self.path))
+            connection.sendall(json.dumps(dict(params, op=op)).encode("utf-8") + b"\n")
+            with connection.makefile("rb") as stream:
+                line = stream.readline()
+        if not line:
+            raise ValueError("Agent closed the connection!")
+        response = json.loads(line)
+        if not response.get("ok"):
+            raise ValueError(response.get("error", "Agent request failed!"))
+        return response
+
+    def ping(self) -> bool:
+        try:
+            return self.request("ping")["ok"]
+        except (OSError, ValueError):
+            return False
+
+    def get(self, name: str) -> str:
+        return self.request("get", name=name)["password"]
+
+    def ls(self, query: Optional[str] = None) -> List[str]:
+        return self.request("ls", query=query)["names"]
+
+    def add(self, name: str, password: str) -> None:
+        self.request("add", name=name, password=password)
+
+    def generate(self, name: str, policy: Optional[str] = None) -> str:
+        return self.request("generate", name=name, policy=policy)["password"]
+
+    def lock(self) -> None:
+        """Makes the agent forget the token and exit."""
+        self.request("lock")
+
+
+def connect(path: Optional[Path] = None, vault: Optional[Path] = None) -> Optional[AgentClient]:
+    """Client of the agent running for `vault`, or None when there is none."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    client = AgentClient(path, vault=vault)
+    if not client.path.exists() or not client.ping():
+        return None
+    return client
+
+
+def serve(manager, path: Optional[Path] = None, idle_timeout: float = config.agent_idle_timeout) -> None:
+    """Runs the agent in this process until it locks."""
+    agent = Agent(manager, path, idle_timeout)
+    print(f"Agent listening on {agent.path}, locks after {idle_timeout:g} s of inactivity.", file=sys.stderr)
+    agent.serve()
@@ -0,0 +1,126 @@
+"""asyncio interface of the password manager.
+
+SQLite is used from a single dedicated I/O thread, so the vault is never touched by two threads at once. CPU-bound
+work, the KDF and password generation, runs on a bounded pool of crypto threads. The event loop only waits."""
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, List, Optional, TypeVar, Union
+
+import src.config as config
+import src.kdf as kdf
+import src.persistence as persistence
+from src.interface import Alphabet, Generator, PasswordManager, Policy, Usage
+
+T = TypeVar("T")
+
+
+class AsyncPasswordManager:
+    """Awaitable counterpart of `PasswordManager`. Create it, `await unlock(...)` and `await close()` when done,
+    or use it as `async with`."""
+
+    def __init__(self, crypto_workers: int = config.async_crypto_workers):
+        if crypto_workers < 1:
+            raise ValueError("There has to be at least 1 crypto worker!")
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pswdmngr-io")
+        self._crypto = ThreadPoolExecutor(max_workers=crypto_workers, thread_name_prefix="pswdmngr-crypto")
+        self.manager: Optional[PasswordManager] = None
+
+    async def __aenter__(self) -> AsyncPasswordManager:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def _run_io(self, function: Callable[..., T], *args, **kwargs) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._io, partial(function, *args, **kwargs))
+
+    async def _run_crypto(self, function: Callable[..., T], *args, **kwargs) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._crypto, partial(function, *args, **kwargs))
+
+    def _unlocked(self) -> PasswordManager:
+        if self.manager is None:
+            raise ValueError("Vault is locked!")
+        return self.manager
+
+    async def unlock(self, user_password: str, progress: Optional[kdf.Progress] = None,
+                     path: Optional[Union[str, Path]] = None) -> None:
+        """Opens the vault at `path`, by default the one in the project root, creating it on the first run.
+        `progress` is called on the event loop. Cancelling the awaiting task stops the derivation where the KDF
+        reports its progress."""
+        if not isinstance(user_password, str):
+            raise TypeError("Application password must be a string!")
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+
+        def report(fraction: float) -> None:
+            if cancelled.is_set():
+                raise kdf.Cancelled()
+            if progress:
+                loop.call_soon_threadsafe(progress, fraction)
+
+        def run_kdf(job: Callable[[], bytes]) -> bytes:
+            # Called on the I/O thread, which has nothing to do until the token is known.
+            return self._crypto.submit(job).result()
+
+        def open_vault() -> persistence.Persistence:
+            vault = persistence.Persistence(path=path)
+            vault.unlock(user_password, report, run_kdf)
+            return vault
+
+        try:
+            vault = await self._run_io(open_vault)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        self.manager = PasswordManager.from_persistence(vault)
+
+    async def lock(self) -> None:
+        """Forgets the token and everything decrypted with it."""
+        if self.manager is not None:
+            manager, self.manager = self.manager, None
+            await self._run_io(manager.lock)
+
+    async def close(self) -> None:
+        """Locks the vault and stops the worker threads."""
+        await self.lock()
+        self._io.shutdown(wait=False)
+        self._crypto.shutdown(wait=False)
+
+    async def services(self) -> List[persistence.Service]:
+        return await self._run_io(lambda: self._unlocked().services)
+
+    async def get_service(self, idx: int) -> Optional[persistence.Service]:
+        return await self._run_io(self._unlocked().get_service, idx)
+
+    async def find_service(self, name: str) -> Optional[persistence.Service]:
+        return await self._run_io(self._unlocked().find_service, name)
+
+    async def search(self, query: str, limit: Optional[int] = None) -> List[persistence.Service]:
+        return await self._run_io(self._unlocked().search, query, limit)
+
+    async def password(self, service: persistence.Service) -> str:
+        """Decrypts the password of a service on a crypto thread."""
+        return await self._run_crypto(lambda: service.password)
+
+    async def add_service(
+            self,
+            name: str,
+            length: int = config.default_length,
+            alphabet: Alphabet = Alphabet(Usage.ENFORCE, Usage.ENFORCE, Usage.ENFORCE, Usage.ENFORCE),
+            password: str = None,
+            policy: Optional[Policy] = None
+    ) -> Optional[persistence.Service]:
+        """Same as `PasswordManager.add_service`, the password is generated on a crypto thread."""
+        manager = self._unlocked()
+        if not password:
+            generator = policy.generator() if policy is not None else Generator(alphabet, length)
+            password = await self._run_crypto(generator.generate_password)
+        return await self._run_io(manager.add_service, name, password=password, policy=policy)
+
+    async def remove_service(self, idx: int) -> str:
+        return await self._run_io(self._unlocked().remove_service, idx)
@@ -1,19 +1,57 @@
 from __future__ import annotations
 
 import string
-from typing import List
-from PyQt5 import QtWidgets, QtCore
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional
+from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtCore import QModelIndex, Qt
 from PyQt5.QtGui import QFont
-from PyQt5.uic.properties import QtGui
 import re
 
 from src.utils import is_first_init
-from src.interface import Usage, Alphabet
-import src.interface as iface
+from src.kdf import Cancelled
 import src.config as config
-from src.ui import auth, main_w, generate, first_auth, add
-from src.persistence import Service
+from src.ui import auth, main_w, first_auth
+
+# The application core pulls in the ciphers, it is imported by the unlock worker once the login window is shown.
+if TYPE_CHECKING:
+    import src.interface as iface
+    from src.persistence import Service
+
+
+class UnlockWorker(QtCore.QObject):
+    """Derives the vault token outside of the GUI thread so the window keeps responding."""
+
+    progress = QtCore.pyqtSignal(float)
+    unlocked = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, user_password: str):
+        super().__init__()
+        self.user_password = user_password
+        self.cancelled = False
+
+    def run(self):
+        try:
+            import src.interface as iface
+            self.unlocked.emit(iface.PasswordManager(self.user_password, self.report))
+        except Cancelled:
+            pass
+        except ValueError as e:
+            self.failed.emit(str(e))
+        finally:
+            self.finished.emit()
+
+    def report(self, fraction: float):
+        """Progress callback of the KDF, also the place where the cancellation takes effect."""
+        if self.cancelled:
+            raise Cancelled()
+        self.progress.emit(fraction)
+
+    def cancel(self):
+        self.cancelled = True
 
 
 class LoginDialog(QtWidgets.QDialog):
@@ -33,16 +71,26 @@ class LoginDialog(QtWidgets.QDialog):
             self.child = None
 
             self.ui.pushButton.clicked.connect(self.authenticate)
-        self.rejected.connect(self.parent().close)
+        self.unlock_thread = None
+        self.worker = None
+        self.progress_bar = QtWidgets.QProgressBar(self)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.hide()
+        self.ui.verticalLayout.addWidget(self.progress_bar)
+        self.rejected.connect(self.close_application)
         self.setWindowState(Qt.WindowActive)
         self.show()
 
     def authenticate(self):
         """Authentication after the user account is set."""
+        if self.worker:
+            return self.cancel_unlock()
         self._init_manager()
 
     def first_authenticate(self):
         """Setting up the password."""
+        if self.worker:
+            return self.cancel_unlock()
         line1 = self.ui.lineEdit.text()
         line2 = self.ui.lineEdit_2.text()
         if not line1 == line2:
@@ -62,20 +110,70 @@ class LoginDialog(QtWidgets.QDialog):
         self._init_manager()
 
     def _init_manager(self):
-        """Tries to authenticate. Displays error message window or initiates the main window."""
-        try:
-            manager = iface.PasswordManager(self.ui.lineEdit.text())
-            self.parent().manager = manager
-            self.parent().init_data()
-            self.parent().resize_table()
-            self.parent().ui.generate_password.setEnabled(True)
-            self.parent().ui.store_password.setEnabled(True)
-            self.accept()
-        except ValueError:
-            error_dialog = QtWidgets.QMessageBox(self)
-            error_dialog.setText("Wrong password!")
-            error_dialog.show()
-            self.ui.lineEdit.setText("")
+        """Starts the authentication on a worker thread. The button cancels it until it finishes."""
+        self.worker = UnlockWorker(self.ui.lineEdit.text())
+        self.unlock_thread = QtCore.QThread(self)
+        self.worker.moveToThread(self.unlock_thread)
+        self.unlock_thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.unlocked.connect(self.unlocked)
+        self.worker.failed.connect(self.failed)
+        self.worker.finished.connect(self.unlock_thread.quit)
+        self.unlock_thread.finished.connect(self.unlock_finished)
+        self.ui.lineEdit.setEnabled(False)
+        self.ui.pushButton.setText("Cancel")
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.show()
+        self.unlock_thread.start()
+
+    def show_progress(self, fraction: float):
+        """Native KDFs only report start and end, keep the busy indicator for them."""
+        if 0 < fraction < 1:
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(int(fraction * 100))
+
+    def unlocked(self, manager: iface.PasswordManager):
+        """Displays the main window as soon as the token is ready."""
+        if self.worker is None or self.worker.cancelled:
+            return
+        self.parent().manager = manager
+        self.parent().init_data()
+        self.parent().resize_table()
+        self.parent().ui.generate_password.setEnabled(True)
+        self.parent().ui.store_password.setEnabled(True)
+        self.parent().ui.lineEditSearch.setEnabled(True)
+        self.accept()
+
+    def failed(self, message: str):
+        """Shows why the unlock failed, a wrong password or a vault busy in another process."""
+        error_dialog = QtWidgets.QMessageBox(self)
+        error_dialog.setText(message)
+        error_dialog.show()
+        self.ui.lineEdit.setText("")
+
+    def cancel_unlock(self):
+        """Stops the running authentication without waiting for it. Native KDFs notice it only when they finish,
+        `unlock_finished` cleans up then."""
+        if self.worker:
+            self.worker.cancel()
+            self.ui.pushButton.setEnabled(False)
+
+    def close_application(self):
+        """Closes the main window at once, the process ends after a running derivation noticed the cancellation."""
+        if self.unlock_thread is None:
+            self.parent().close()
+            return
+        self.parent().hide()
+        self.unlock_thread.finished.connect(self.parent().close)
+        self.cancel_unlock()
+
+    def unlock_finished(self):
+        self.worker = None
+        self.unlock_thread = None
+        self.progress_bar.hide()
+        self.ui.lineEdit.setEnabled(True)
+        self.ui.pushButton.setEnabled(True)
+        self.ui.pushButton.setText("Ok")
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -91,6 +189,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.manager = None
         self.ui.generate_password.setDisabled(True)
         self.ui.store_password.setDisabled(True)
+        self.ui.lineEditSearch.setDisabled(True)
 
         self.login_dialog = LoginDialog(self)
         self.login_dialog.setWindowTitle("Unlock the application:")
@@ -99,41 +198,92 @@ class MainWindow(QtWidgets.QMainWindow):
             QtWidgets.QTableView.SelectionBehavior.SelectRows
         )
         self.ui.tableView.verticalHeader().setVisible(False)
+        # Measure only the visible rows, the others are not decrypted yet.
+        self.ui.tableView.horizontalHeader().setResizeContentsPrecision(0)
         self.ui.tableView.clicked.connect(self.copy_password)
         self.ui.actionDelete.triggered.connect(self.delete_item)
         self.ui.tableView.addAction(self.ui.actionDelete)
         self.child_generate_password = None
-        self.child_add_password = AddServiceDialogAdd(self)
+        self.child_add_password = None
 
+        self.ui.lineEditSearch.textChanged.connect(self.search)
         self.ui.generate_password.clicked.connect(self.add_service)
-        self.ui.store_password.clicked.connect(self.child_add_password.show)
+        self.ui.store_password.clicked.connect(self.store_service)
+
+        # Other processes may change the vault meanwhile, their changes are picked up periodically.
+        self.change_timer = QtCore.QTimer(self)
+        self.change_timer.setInterval(config.change_poll_interval)
+        self.change_timer.timeout.connect(self.reload_changes)
 
         self.show()
 
     def copy_password(self, item: QModelIndex):
         """Doubleclick on a service copies the password to your clipboard."""
-        service = self.ui.tableView.model().data[item.row()][0]
+        service = self.ui.tableView.model().service(item.row())
+        if service is None:
+            return
         QtWidgets.QApplication.clipboard().setText(service.password)
-        self.ui.tableView.model().data[item.row()] = (service, service.password)
-        self.resize_table()
+        self.ui.tableView.model().update(service, service.password)
 
     def add_service(self):
         """Opens dialog for adding services."""
         self.child_generate_password = AddServiceDialogGenerate(self)
         self.child_generate_password.show()
 
+    def store_service(self):
+        """Opens dialog for adding services with your own password, built on the first use."""
+        if self.child_add_password is None:
+            self.child_add_password = AddServiceDialogAdd(self)
+        self.child_add_password.show()
+
     def init_data(self):
         """Fills the table and adjust its size."""
-        self.ui.tableView.setModel(
-            ServiceTableModel(
-                [(s, "*****") for s in self.manager.services]
-            )
-        )
+        self.ui.tableView.setModel(ServiceTableModel(self.manager))
         self.resize_table()
+        self.change_timer.start()
+
+    def reload_changes(self):
+        """Shows the services changed by other processes, only the changed rows are reloaded."""
+        try:
+            changed = self.manager.poll_changes()
+        except ValueError:
+            # The vault is busy, the next tick tries again.
+            return
+        if not changed and changed is not None:
+            return
+        if changed is None:
+            self.init_data()
+        else:
+            model = self.ui.tableView.model()
+            for idx in changed:
+                row = model.replace(idx, self.manager.get_service(idx))
+                if row >= 0:
+                    self.fit_row(row)
+        if self.ui.lineEditSearch.text().strip():
+            self.search(self.ui.lineEditSearch.text())
+
+    def search(self, text: str):
+        """Shows only the services matching the search box, best match first."""
+        model = self.ui.tableView.model()
+        if not text.strip():
+            model.show_ranked(None)
+        else:
+            model.show_ranked(self.manager.search(text, config.search_limit))
 
     def resize_table(self):
         """Adjust the size of the table."""
         self.ui.tableView.resizeColumnToContents(0)
+        self.stretch_table()
+
+    def fit_row(self, row: int):
+        """Widens the service column for a new or renamed service without measuring the other rows."""
+        width = self.ui.tableView.sizeHintForIndex(self.ui.tableView.model().index(row, 0)).width()
+        if width > self.ui.tableView.columnWidth(0):
+            self.ui.tableView.setColumnWidth(0, width)
+            self.stretch_table()
+
+    def stretch_table(self):
+        """Lets the password column take the rest of the table."""
         self.ui.tableView.setColumnWidth(
             1, self.ui.tableView.width() - self.ui.tableView.columnWidth(0) - 2
         )
@@ -141,7 +291,7 @@ class MainWindow(QtWidgets.QMainWindow):
     def delete_item(self):
         """Open dialog to confirm the deletion and proceed to delete."""
         indexes = set([i.row() for i in self.ui.tableView.selectedIndexes()])
-        services = [self.ui.tableView.model().data[i][0] for i in indexes]
+        services = [service for service in map(self.ui.tableView.model().service, indexes) if service is not None]
         if not services:
             return
         reply = QtWidgets.QMessageBox.question(
@@ -151,13 +301,17 @@ class MainWindow(QtWidgets.QMainWindow):
             QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
         )
         if reply == QtWidgets.QMessageBox.Yes:
-            for s in services:
-                self.manager.remove_service(s.idx)
-            self.init_data()
+            ids = [s.idx for s in services]
+            try:
+                self.manager.remove_services(ids)
+            except ValueError as e:
+                QtWidgets.QMessageBox.warning(self, "Not deleted", str(e))
+                return
+            self.ui.tableView.model().remove(ids)
 
     def resizeEvent(self, a0: QtGui.QResizeEvent) -> None:
         super(MainWindow, self).resizeEvent(a0)
-        self.resize_table()
+        self.stretch_table()
 
     def set_location(self):
         """Positions the application to the bottom-right corner of the screen."""
@@ -169,15 +323,123 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
 class ServiceTableModel(QtCore.QAbstractTableModel):
-    """Nodel for displaying the data in the table."""
+    """Nodel for displaying the data in the table. Rows are fetched from the database page by page as the view
+    scrolls, and names are decrypted only for the rows being displayed, keeping a bounded LRU of them."""
 
-    def __init__(self, data: List[(Service, str)], parent=None):
+    def __init__(self, manager: iface.PasswordManager, parent=None):
         super(ServiceTableModel, self).__init__(parent)
-        data.sort(key=lambda x: x[0].idx)
-        self.data = data
+        self.manager = manager
+        self.ids: List[int] = []
+        self.exhausted = False
+        self.cache: OrderedDict[int, Service] = OrderedDict()
+        self.revealed: Dict[int, str] = {}
+        # Search results are shown in the order of their rank instead of by idx.
+        self.ranked = False
+
+    def show_ranked(self, services: Optional[List[Service]]):
+        """Displays only the given services in the given order, or goes back to all of them with None. They are
+        decrypted already, so they go straight into the cache."""
+        self.beginResetModel()
+        self.ranked = services is not None
+        self.ids = [service.idx for service in services] if self.ranked else []
+        self.exhausted = self.ranked
+        for service in reversed(services or []):
+            self._remember(service)
+        self.endResetModel()
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        return not self.exhausted
+
+    def fetchMore(self, parent: QModelIndex) -> None:
+        """Keyset pagination: continues after the last idx we have."""
+        page = self.manager.get_service_ids(self.ids[-1] if self.ids else 0, config.table_fetch_size)
+        if len(page) < config.table_fetch_size:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.ids), len(self.ids) + len(page) - 1)
+            self.ids.extend(page)
+            self.endInsertRows()
+
+    def service(self, row: int) -> Optional[Service]:
+        """Decrypted service of a row. A miss decrypts the page of rows starting at it. None when another process
+        deleted the service before we noticed, its row is removed once the view is done painting."""
+        idx = self.ids[row]
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+        # Ranked rows are scattered over the vault, a page would hold at most one of them.
+        if self.ranked:
+            page = [self.manager.get_service(idx)]
+        else:
+            page = self.manager.get_services_page(idx - 1, config.table_fetch_size)
+        for service in page:
+            if service is not None:
+                self._remember(service)
+        if idx not in self.cache:
+            QtCore.QTimer.singleShot(0, lambda: self.remove([idx]))
+            return None
+        return self.cache[idx]
+
+    def _remember(self, service: Service):
+        self.cache[service.idx] = service
+        self.cache.move_to_end(service.idx)
+        while len(self.cache) > config.table_cache_size:
+            self.cache.popitem(last=False)
+
+    def row_of(self, idx: int) -> int:
+        """Binary search for the row of a service, or the row it would be inserted at."""
+        if self.ranked:
+            return self.ids.index(idx) if idx in self.ids else len(self.ids)
+        return bisect_left(self.ids, idx)
+
+    def insert(self, service: Service) -> int:
+        """Adds a new service at its place and returns its row, or -1 when it lies in the part not fetched yet or
+        search results are displayed."""
+        row = self.row_of(service.idx)
+        if self.ranked or (row == len(self.ids) and not self.exhausted):
+            return -1
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.ids.insert(row, service.idx)
+        self.endInsertRows()
+        self._remember(service)
+        return row
+
+    def remove(self, ids: List[int]):
+        """Removes services by their ids, the view only updates the affected rows."""
+        for idx in ids:
+            row = self.row_of(idx)
+            if row < len(self.ids) and self.ids[row] == idx:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.ids[row]
+                self.endRemoveRows()
+            self.cache.pop(idx, None)
+            self.revealed.pop(idx, None)
+
+    def update(self, service: Service, password: str = None) -> int:
+        """Replaces a changed service and optionally reveals its password. Returns its row or -1 when it is not
+        displayed."""
+        row = self.row_of(service.idx)
+        if row >= len(self.ids) or self.ids[row] != service.idx:
+            return -1
+        self._remember(service)
+        if password is not None:
+            self.revealed[service.idx] = password
+        self.dataChanged.emit(self.index(row, 0), self.index(row, 1))
+        return row
+
+    def replace(self, idx: int, service: Optional[Service]) -> int:
+        """Shows the stored state of a service changed elsewhere: updates, inserts or, with None, removes it. Its
+        password is hidden again. Returns its row or -1 when it is not displayed."""
+        self.cache.pop(idx, None)
+        self.revealed.pop(idx, None)
+        if service is None:
+            self.remove([idx])
+            return -1
+        row = self.update(service)
+        return row if row >= 0 else self.insert(service)
 
     def rowCount(self, parent: QModelIndex = ...) -> int:
-        return len(self.data)
+        return len(self.ids)
 
     def columnCount(self, parent: QModelIndex = ...) -> int:
         return 2
@@ -186,7 +448,10 @@ class ServiceTableModel(QtCore.QAbstractTableModel):
         if role == QtCore.Qt.DisplayRole:
             row = index.row()
             col = index.column()
-            return str(self.data[row][col])
+            if col == 0:
+                service = self.service(row)
+                return str(service) if service is not None else ""
+            return self.revealed.get(self.ids[row], "*****")
 
     def headerData(self, section: int, orientation: Qt.Orientation, role: int = ...):
         if role == QtCore.Qt.DisplayRole:
@@ -198,17 +463,46 @@ class ServiceTableModel(QtCore.QAbstractTableModel):
 
 
 class AddServiceDialogGenerate(QtWidgets.QDialog):
-    """Dialog that lets you add a service and change the attributes of its password."""
+    """Dialog that lets you add a service and change the attributes of its password. The options are saved as a
+    policy, the last used one is filled in when the dialog opens."""
 
     def __init__(self, parent=None):
+        from src.ui import generate
         super().__init__(parent)
         self.ui = generate.Ui_Dialog()
         self.ui.setupUi(self)
         self.setWindowTitle("Add a service")
         self.ui.lineEditLength.setPlaceholderText(str(config.default_length))
         self.ui.lineEditSpecialSymbols.setPlaceholderText(config.default_special_characters)
+        # (enforce, allow) check boxes of lowercase, uppercase, numbers and special symbols.
+        self.checkboxes = (
+            (self.ui.checkBoxEnforceLowercase, self.ui.checkBoxAllowLowercase),
+            (self.ui.checkBoxEnforceUppercase, self.ui.checkBoxAllowUppercase),
+            (self.ui.checkBoxEnforceNumbers, self.ui.checkBoxAllowNumbers),
+            (self.ui.checkBoxEnforceSpecialSymbols, self.ui.checkBoxAllowSpecialSymbols),
+        )
+        self.policies = {policy.name: policy for policy in self.parent().manager.policies}
+        self.ui.comboBoxPolicy.addItems(list(self.policies) or [config.default_policy_name])
+        self.ui.comboBoxPolicy.currentTextChanged.connect(self.show_policy)
+        self.show_policy(self.ui.comboBoxPolicy.currentText())
+
+    def show_policy(self, name: str) -> None:
+        """Fills the options of a saved policy in."""
+        from src.interface import Usage
+        policy = self.policies.get(name)
+        if policy is None:
+            return
+        self.ui.lineEditLength.setText(str(policy.length))
+        for usage, (enforce, allow) in zip(policy.alphabet.usages, self.checkboxes):
+            enforce.setChecked(usage == Usage.ENFORCE)
+            allow.setChecked(usage != Usage.DISALLOW)
+        if policy.specials_to_use != config.default_special_characters:
+            self.ui.lineEditSpecialSymbols.setText(policy.specials_to_use)
+        else:
+            self.ui.lineEditSpecialSymbols.setText("")
 
     def accept(self) -> None:
+        from src.interface import Policy, Usage
         name = self.ui.lineEditName.text()
         if not name:
             return self.reject()
@@ -217,35 +511,24 @@ class AddServiceDialogGenerate(QtWidgets.QDialog):
             length = config.default_length
         else:
             length = int(length)
-        lowercase = Usage.DISALLOW
-        uppercase = Usage.DISALLOW
-        numbers = Usage.DISALLOW
-        special_symbols = Usage.DISALLOW
-        if self.ui.checkBoxEnforceLowercase.isChecked():
-            lowercase = Usage.ENFORCE
-        elif self.ui.checkBoxAllowLowercase.isChecked():
-            lowercase = Usage.ALLOW
-        if self.ui.checkBoxEnforceUppercase.isChecked():
-            uppercase = Usage.ENFORCE
-        elif self.ui.checkBoxAllowUppercase.isChecked():
-            uppercase = Usage.ALLOW
-        if self.ui.checkBoxEnforceNumbers.isChecked():
-            numbers = Usage.ENFORCE
-        elif self.ui.checkBoxAllowNumbers.isChecked():
-            numbers = Usage.ALLOW
-        specials_to_use = "".join(set(self.ui.lineEditSpecialSymbols.text()))
+        usages = []
+        for enforce, allow in self.checkboxes:
+            if enforce.isChecked():
+                usages.append(Usage.ENFORCE)
+            elif allow.isChecked():
+                usages.append(Usage.ALLOW)
+            else:
+                usages.append(Usage.DISALLOW)
+        specials_to_use = self.ui.lineEditSpecialSymbols.text()
         if not specials_to_use:
             specials_to_use = config.default_special_characters
-        if self.ui.checkBoxEnforceSpecialSymbols.isChecked():
-            special_symbols = Usage.ENFORCE
-        elif self.ui.checkBoxAllowSpecialSymbols.isChecked():
-            special_symbols = Usage.ALLOW
-        self.ui.lineEditName.setText('')
-        alphabet = Alphabet(lowercase, uppercase, numbers, special_symbols, specials_to_use)
+        policy_name = self.ui.comboBoxPolicy.currentText() or config.default_policy_name
+        policy = Policy(policy_name, length, *usages, specials_to_use)
         try:
-            self.parent().manager.add_service(
-                name, length, alphabet
-            )
+            if self.parent().manager.changes_policy(policy) and not self.confirm_policy_change(policy_name):
+                return
+            self.ui.lineEditName.setText('')
+            service = self.parent().manager.add_service(name, policy=policy)
         except Exception as e:
             message = QtWidgets.QMessageBox(self)
             message.setText(str(e))
@@ -253,25 +536,50 @@ class AddServiceDialogGenerate(QtWidgets.QDialog):
             self.reject()
             return
 
-        self.parent().init_data()
+        if service:
+            row = self.parent().ui.tableView.model().insert(service)
+            if row >= 0:
+                self.parent().fit_row(row)
         self.hide()
 
+    def confirm_policy_change(self, name: str) -> bool:
+        """Asks before other options are saved into an existing policy, a new policy name keeps it as it is."""
+        reply = QtWidgets.QMessageBox.question(
+            self,
+            "Change the policy?",
+            f"Policy {name} has other options. Do you want to save these into it? Services generated by it before"
+            f" will be regenerated with them, enter a new policy name to keep {name} as it is.",
+            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+        )
+        return reply == QtWidgets.QMessageBox.Yes
+
     def reject(self) -> None:
         self.hide()
 
 
 class AddServiceDialogAdd(QtWidgets.QDialog):
     def __init__(self, parent=None):
+        from src.ui import add
         super().__init__(parent)
         self.ui = add.Ui_Dialog()
         self.ui.setupUi(self)
         self.setWindowTitle("Add a service")
 
     def accept(self) -> None:
-        self.parent().manager.add_service(self.ui.lineEditName.text(), password=self.ui.lineEditPassword.text())
+        try:
+            service = self.parent().manager.add_service(self.ui.lineEditName.text(),
+                                                        password=self.ui.lineEditPassword.text())
+        except ValueError as e:
+            message = QtWidgets.QMessageBox(self)
+            message.setText(str(e))
+            message.show()
+            return
         self.ui.lineEditName.setText('')
         self.ui.lineEditPassword.setText('')
-        self.parent().init_data()
+        if service:
+            row = self.parent().ui.tableView.model().insert(service)
+            if row >= 0:
+                self.parent().fit_row(row)
         self.hide()
 
     def reject(self) -> None:
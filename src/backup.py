@@ -0,0 +1,102 @@
+"""Encrypted backup format.
+
+A backup starts with `magic`, followed by a length-prefixed JSON header describing the KDF of the backup password.
+Then come chunks of JSON lines (`{"name": ..., "password": ...}`), each encrypted with AES-GCM on its own: 4 bytes of
+ciphertext length, 1 byte telling whether it is the last chunk, the ciphertext and the 16 byte tag. Chunk number is
+the nonce and the header together with the last-chunk flag is authenticated, so reordered, truncated or modified
+backups are rejected."""
+from __future__ import annotations
+
+import json
+import struct
+from typing import IO, Iterator, Optional, Tuple
+
+from Crypto.Cipher import AES
+
+import src.config as config
+import src.kdf as kdf
+from src.utils import rand_bytes
+
+magic: bytes = b"PMBK\x01"
+tag_length: int = 16
+
+
+class BackupWriter:
+    """Packs records into fixed-size encrypted chunks. Only one chunk is held in memory at a time."""
+
+    def __init__(self, export_password: str, derivation: kdf.KDF = None, chunk_size: int = config.export_chunk_size):
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be positive!")
+        if derivation is None:
+            derivation = kdf.default()
+        seed = rand_bytes(32)
+        header = json.dumps({"algorithm": derivation.algorithm, "params": derivation.params, "seed": seed.hex()})
+        self.header = magic + struct.pack(">H", len(header)) + header.encode("utf-8")
+        self.key = derivation.derive(export_password, seed)
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.counter = 0
+
+    def add(self, name: str, password: str) -> Iterator[bytes]:
+        """Buffers one record and yields the chunks it completed."""
+        self.buffer += json.dumps({"name": name, "password": password}).encode("utf-8") + b"\n"
+        while len(self.buffer) >= self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            yield self._seal(chunk, False)
+
+    def finish(self) -> bytes:
+        """Seals the rest of the buffer as the last chunk."""
+        chunk = bytes(self.buffer)
+        self.buffer.clear()
+        return self._seal(chunk, True)
+
+    def _seal(self, chunk: bytes, final: bool) -> bytes:
+        cipher = _cipher(self.key, self.counter, self.header, final)
+        self.counter += 1
+        ciphertext, tag = cipher.encrypt_and_digest(chunk)
+        return struct.pack(">I?", len(ciphertext), final) + ciphertext + tag
+
+
+def _cipher(key: bytes, counter: int, header: bytes, final: bool):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=counter.to_bytes(12, "big"))
+    cipher.update(header + bytes([final]))
+    return cipher
+
+
+def _read_exactly(stream: IO[bytes], size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Backup is truncated!")
+    return data
+
+
+def read_records(stream: IO[bytes], export_password: str) -> Iterator[Tuple[str, str]]:
+    """Streams `(name, password)` pairs out of a backup, decrypting one chunk at a time."""
+    if _read_exactly(stream, len(magic)) != magic:
+        raise ValueError("Not a backup of this application!")
+    raw_length = _read_exactly(stream, 2)
+    raw_header = _read_exactly(stream, struct.unpack(">H", raw_length)[0])
+    header = json.loads(raw_header)
+    derivation = kdf.load(header["algorithm"], json.dumps(header["params"]))
+    key = derivation.derive(export_password, bytes.fromhex(header["seed"]))
+    header_bytes = magic + raw_length + raw_header
+    pending = b""
+    counter = 0
+    final: Optional[bool] = False
+    while not final:
+        length, final = struct.unpack(">I?", _read_exactly(stream, 5))
+        ciphertext = _read_exactly(stream, length)
+        tag = _read_exactly(stream, tag_length)
+        try:
+            chunk = _cipher(key, counter, header_bytes, final).decrypt_and_verify(ciphertext, tag)
+        except ValueError:
+            raise ValueError("Incorrect password or corrupted backup!")
+        counter += 1
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            record = json.loads(line)
+            yield record["name"], record["password"]
+    if pending:
+        raise ValueError("Backup is truncated!")
@@ -0,0 +1,309 @@
+"""Micro benchmarks of the application. Run `python -m src.benchmark --help` for the available suites."""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import src.config as config
+import src.kdf as kdf
+from src.interface import Alphabet, Generator, Usage
+from src.utils import get_project_root, rand_bytes
+
+alphabets: Dict[str, Tuple[Usage, Usage, Usage, Usage]] = {
+    "digits+lowercase": (Usage.ALLOW, Usage.DISALLOW, Usage.ENFORCE, Usage.DISALLOW),
+    "alphanumeric": (Usage.ENFORCE, Usage.ENFORCE, Usage.ENFORCE, Usage.DISALLOW),
+    "all allowed": (Usage.ALLOW, Usage.ALLOW, Usage.ALLOW, Usage.ALLOW),
+    "all enforced": (Usage.ENFORCE, Usage.ENFORCE, Usage.ENFORCE, Usage.ENFORCE),
+}
+
+
+def measure(function: Callable[[], object], repeat: int) -> float:
+    """Returns the best wall time of `repeat` runs of `function` in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def kdf_candidates(iterations: int) -> List[Tuple[str, kdf.KDF]]:
+    """KDFs to compare. The first group performs roughly the same number of SHA3 permutations as the legacy chain
+    (one HMAC iteration costs two hash invocations), so the attacker pays the same for a guess and only the speed of
+    the defender differs. The second group are the defaults for new vaults."""
+    return [
+        ("equal cost", kdf.Sha3Chain(iterations)),
+        ("equal cost", kdf.Pbkdf2(max(iterations // 2, 1), "sha3_256")),
+        ("default", kdf.Pbkdf2()),
+        ("default", kdf.Scrypt()),
+    ]
+
+
+def bench_kdf(args: argparse.Namespace) -> None:
+    """Compares the unlock latency of the key derivation functions."""
+    seed = rand_bytes(config.seed_length)
+    print(f"{'group':<12}{'algorithm':<58}{'seconds':>10}")
+    for group, derivation in kdf_candidates(args.iterations):
+        elapsed = measure(lambda: derivation.derive("correct horse battery staple", seed), args.repeat)
+        print(f"{group:<12}{repr(derivation):<58}{elapsed:>10.3f}")
+
+
+def bench_calibrate(args: argparse.Namespace) -> None:
+    """Shows the cost every KDF would be calibrated to on this machine and how long it really takes."""
+    seed = rand_bytes(config.seed_length)
+    print(f"{'algorithm':<58}{'seconds':>10}")
+    for algorithm in kdf.algorithms:
+        derivation = kdf.calibrate(algorithm, args.target)
+        elapsed = measure(lambda: derivation.derive("correct horse battery staple", seed), args.repeat)
+        print(f"{repr(derivation):<58}{elapsed:>10.3f}")
+
+
+def bench_generator(args: argparse.Namespace) -> None:
+    """Measures the throughput of the password generator across lengths and alphabets."""
+    results = []
+    for name, usages in alphabets.items():
+        for length in args.lengths:
+            generator = Generator(Alphabet(*usages), length)
+            count = max(args.symbols // length, 1)
+            elapsed = measure(lambda: generator.generate_many(count, length), args.repeat)
+            results.append({"alphabet": name, "length": length, "passwords": count, "seconds": elapsed,
+                            "passwords_per_second": count / elapsed, "symbols_per_second": count * length / elapsed})
+    if args.json:
+        print(json.dumps({"suite": "generator", "results": results}, indent=2))
+        return
+    print(f"{'alphabet':<20}{'length':>8}{'passwords/s':>16}{'symbols/s':>16}")
+    for result in results:
+        print(f"{result['alphabet']:<20}{result['length']:>8}{result['passwords_per_second']:>16.0f}"
+              f"{result['symbols_per_second']:>16.0f}")
+
+
+def chi_square_p_value(statistic: float, degrees: int) -> float:
+    """Upper tail probability of the chi-square distribution, using the Wilson-Hilferty normal approximation."""
+    if degrees < 1:
+        return 1.0
+    z = ((statistic / degrees) ** (1 / 3) - (1 - 2 / (9 * degrees))) / math.sqrt(2 / (9 * degrees))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def chi_square(observed: List[int], expected: List[float]) -> Tuple[float, int]:
+    return sum((o - e) ** 2 / e for o, e in zip(observed, expected)), len(observed) - 1
+
+
+def expected_frequencies(alphabet: Alphabet, length: int) -> Dict[str, float]:
+    """Expected number of occurrences of each symbol in one password: one symbol of every enforced group, the rest
+    uniformly from the pool."""
+    expected = {symbol: (length - len(alphabet.groups)) / len(alphabet.symbol_pool)
+                for symbol in alphabet.symbol_pool}
+    for group in alphabet.groups:
+        for symbol in group:
+            expected[symbol] += 1 / len(group)
+    return expected
+
+
+def quality_tests(name: str, alphabet: Alphabet, length: int, count: int) -> List[dict]:
+    """Checks that every symbol is drawn as often as it should be, and that the symbols of every enforced group are
+    spread evenly over all positions."""
+    passwords = Generator(alphabet, length).generate_many(count)
+    symbols = Counter("".join(passwords))
+    expected = expected_frequencies(alphabet, length)
+    pool = sorted(expected)
+    statistic, degrees = chi_square([symbols[s] for s in pool], [expected[s] * count for s in pool])
+    results = [{"alphabet": name, "length": length, "test": "symbol frequency", "statistic": statistic,
+                "degrees": degrees, "p_value": chi_square_p_value(statistic, degrees)}]
+    for group in alphabet.groups:
+        members = set(group)
+        observed = [sum(password[i] in members for password in passwords) for i in range(length)]
+        total = sum(observed)
+        statistic, degrees = chi_square(observed, [total / length] * length)
+        results.append({"alphabet": name, "length": length, "test": f"positions of {group[:3]}...",
+                        "statistic": statistic, "degrees": degrees, "p_value": chi_square_p_value(statistic, degrees)})
+    return results
+
+
+def bench_quality(args: argparse.Namespace) -> int:
+    """Chi-square tests of the symbol distribution and position uniformity of generated passwords. Exits with 1 when
+    any test fails."""
+    results = []
+    for name, usages in alphabets.items():
+        for length in args.lengths:
+            results += quality_tests(name, Alphabet(*usages), length, args.count)
+    for result in results:
+        result["passed"] = result["p_value"] >= args.alpha
+    failed = sum(not result["passed"] for result in results)
+    if args.json:
+        print(json.dumps({"suite": "quality", "alpha": args.alpha, "failed": failed, "results": results}, indent=2))
+    else:
+        print(f"{'alphabet':<20}{'length':>8}  {'test':<28}{'chi2':>12}{'df':>6}{'p-value':>10}")
+        for result in results:
+            print(f"{result['alphabet']:<20}{result['length']:>8}  {result['test']:<28}{result['statistic']:>12.1f}"
+                  f"{result['degrees']:>6}{result['p_value']:>10.4f}{'' if result['passed'] else '  FAILED'}")
+        print(f"{failed} of {len(results)} tests failed.")
+    return 1 if failed else 0
+
+
+def bench_startup(args: argparse.Namespace) -> None:
+    """Starts the GUI in fresh processes and reports the time until the login window is shown."""
+    env = dict(os.environ)
+    if not env.get("DISPLAY") and not env.get("WAYLAND_DISPLAY"):
+        # Without a display Qt would abort, the window is still created and painted offscreen.
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, str(get_project_root() / "main.py"), "--profile-startup", "--json"],
+                                check=True, capture_output=True, text=True, env=env).stdout
+        runs.append(json.loads(output))
+    times = [run["login_window_ms"] for run in runs]
+    result = {"suite": "startup", "runs": len(times), "best_ms": min(times), "median_ms": statistics.median(times),
+              "imported_modules": runs[-1]["imported_modules"], "phases": runs[-1]["phases"]}
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"{'phase (last run)':<40}{'ms':>10}")
+    for phase in result["phases"]:
+        print(f"{phase['phase']:<40}{phase['ms']:>10.1f}")
+    print(f"Time to login window: best {result['best_ms']:.1f} ms, median {result['median_ms']:.1f} ms "
+          f"of {result['runs']} runs")
+
+
+def stress_run(threads: int, operations: int, services: int, writes: float) -> dict:
+    """Hammers a fresh temporary vault from `threads` threads, then checks it with a new connection."""
+    from src.persistence import Persistence
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "stress.db"
+        vault = Persistence(path=path)
+        vault.set_password("stress", derivation=kdf.Pbkdf2(1000))
+        expected = {f"seed {n}": rand_bytes(12).hex() for n in range(services)}
+        vault.add_services(expected.items())
+        errors: List[str] = []
+        counts = [Counter() for _ in range(threads)]
+        added: List[Dict[str, str]] = [{} for _ in range(threads)]
+        start_together = threading.Barrier(threads + 1)
+
+        def worker(number: int) -> None:
+            rng = random.Random(number)
+            own = added[number]
+            start_together.wait()
+            for n in range(operations):
+                try:
+                    if rng.random() < writes:
+                        name, password = f"thread {number} {n}", rand_bytes(12).hex()
+                        if vault.add_service(name, password) is None:
+                            raise ValueError(f"Could not add {name}!")
+                        own[name] = password
+                        operation = "add"
+                    else:
+                        operation = rng.choice(("list", "find", "page", "ids"))
+                        if operation == "list":
+                            vault.get_services()
+                        elif operation == "find":
+                            # Our own services check that a thread reads its writes.
+                            name = rng.choice(list(own) or list(expected))
+                            service = vault.find_service(name)
+                            if service is None or service.password != own.get(name, expected.get(name)):
+                                raise ValueError(f"Wrong service for {name}!")
+                        elif operation == "page":
+                            vault.get_services_page(rng.randrange(services), 50)
+                        else:
+                            vault.get_service_ids(rng.randrange(services), 100)
+                    counts[number][operation] += 1
+                except Exception as e:
+                    errors.append(f"thread {number}: {e!r}")
+
+        pool = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        for thread in pool:
+            thread.start()
+        start_together.wait()
+        start = time.perf_counter()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for own in added:
+            expected.update(own)
+        counts = sum(counts, Counter())
+        vault.pool.close()
+        check = Persistence(path=path)
+        check.init_token("stress")
+        stored = {service.name: service.password for service in check.get_services()}
+        check.pool.close()
+        if stored != expected:
+            errors.append(f"vault holds {len(stored)} services, {len(expected)} expected or passwords differ")
+    return {"threads": threads, "operations": sum(counts.values()), "seconds": elapsed,
+            "ops_per_second": sum(counts.values()) / elapsed, "counts": dict(counts), "errors": errors}
+
+
+def bench_stress(args: argparse.Namespace) -> int:
+    """Many threads mixing reads and writes on one vault. Fails with 1 on any error or when the vault does not end
+    up with exactly the services added."""
+    results = [stress_run(threads, args.operations, args.services, args.writes) for threads in args.threads]
+    failed = sum(bool(result["errors"]) for result in results)
+    if args.json:
+        print(json.dumps({"suite": "stress", "failed": failed, "results": results}, indent=2))
+    else:
+        print(f"{'threads':>8}{'operations':>12}{'adds':>8}{'ops/s':>12}")
+        for result in results:
+            print(f"{result['threads']:>8}{result['operations']:>12}{result['counts'].get('add', 0):>8}"
+                  f"{result['ops_per_second']:>12.0f}")
+            for error in result["errors"][:10]:
+                print(f"  {error}")
+        print(f"{failed} of {len(results)} runs failed.")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark", description=__doc__)
+    suites = parser.add_subparsers(dest="suite", required=True)
+    kdf_parser = suites.add_parser("kdf", help=bench_kdf.__doc__)
+    kdf_parser.add_argument("--iterations", type=int, default=config.auth_iterations,
+                            help="iterations of the legacy SHA3 chain to compare against")
+    kdf_parser.add_argument("--repeat", type=int, default=3)
+    kdf_parser.set_defaults(run=bench_kdf)
+    calibrate_parser = suites.add_parser("calibrate", help=bench_calibrate.__doc__)
+    calibrate_parser.add_argument("--target", type=float, default=config.unlock_target,
+                                  help="desired unlock time in seconds")
+    calibrate_parser.add_argument("--repeat", type=int, default=3)
+    calibrate_parser.set_defaults(run=bench_calibrate)
+    generator_parser = suites.add_parser("generator", help=bench_generator.__doc__)
+    generator_parser.add_argument("--lengths", type=int, nargs="+", default=[8, 16, 32, 64, 256, 1024, 4096])
+    generator_parser.add_argument("--symbols", type=int, default=200000,
+                                  help="number of symbols generated per measurement")
+    generator_parser.add_argument("--repeat", type=int, default=3)
+    generator_parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    generator_parser.set_defaults(run=bench_generator)
+    quality_parser = suites.add_parser("quality", help=bench_quality.__doc__)
+    quality_parser.add_argument("--lengths", type=int, nargs="+", default=[12, 20])
+    quality_parser.add_argument("--count", type=int, default=20000, help="passwords generated per test")
+    quality_parser.add_argument("--alpha", type=float, default=1e-4,
+                                help="tests with a lower p-value fail, keep it small as many tests run at once")
+    quality_parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    quality_parser.set_defaults(run=bench_quality)
+    startup_parser = suites.add_parser("startup", help=bench_startup.__doc__)
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    startup_parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    startup_parser.set_defaults(run=bench_startup)
+    stress_parser = suites.add_parser("stress", help=bench_stress.__doc__)
+    stress_parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    stress_parser.add_argument("--operations", type=int, default=500, help="operations per thread")
+    stress_parser.add_argument("--services", type=int, default=1000, help="services in the vault at the start")
+    stress_parser.add_argument("--writes", type=float, default=0.1, help="fraction of operations that add")
+    stress_parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    stress_parser.set_defaults(run=bench_stress)
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Command line interface of the password manager. Works without a display, PyQt5 is never imported."""
+from __future__ import annotations
+
+import argparse
+import getpass
+import sys
+from typing import List, Optional
+
+import src.config as config
+from src.utils import is_first_init
+
+usages = ("disallow", "allow", "enforce")
+
+
+def read_password(prompt: str, args: argparse.Namespace) -> str:
+    """Asks for a password on the terminal, or reads the next line of the standard input with `--password-stdin`."""
+    if args.password_stdin:
+        line = sys.stdin.readline()
+        if not line:
+            raise ValueError("Expected a password on the standard input!")
+        return line.rstrip("\n")
+    return getpass.getpass(prompt)
+
+
+def new_password(prompt: str, args: argparse.Namespace) -> str:
+    password = read_password(prompt, args)
+    if not args.password_stdin and getpass.getpass("Repeat: ") != password:
+        raise ValueError("Passwords do not match!")
+    return password
+
+
+def open_manager(args: argparse.Namespace):
+    """Unlocks the vault, creating it on the first run. The application is imported only here, so `--help` and
+    argument errors stay fast."""
+    from src.interface import PasswordManager
+    if is_first_init(args.vault):
+        return PasswordManager(new_password("New main password: ", args), path=args.vault)
+    return PasswordManager(read_password("Main password: ", args), path=args.vault)
+
+
+def agent_client(args: argparse.Namespace):
+    """Client of the running unlock agent, None with `--no-agent` or when no agent runs."""
+    if args.no_agent:
+        return None
+    import src.agent as agent
+    return agent.connect(vault=args.vault)
+
+
+def find(manager, name: str):
+    service = manager.find_service(name)
+    if service is None:
+        raise ValueError(f"Service {name} does not exist!")
+    return service
+
+
+def cmd_ls(args: argparse.Namespace) -> None:
+    """List the services, or the ones matching a search query."""
+    client = agent_client(args)
+    if client:
+        for name in client.ls(args.query):
+            print(name)
+        return
+    manager = open_manager(args)
+    services = manager.search(args.query, config.search_limit) if args.query else manager.services
+    for service in services:
+        print(service.name)
+
+
+def cmd_get(args: argparse.Namespace) -> None:
+    """Print the password of a service."""
+    client = agent_client(args)
+    if client:
+        print(client.get(args.name))
+        return
+    print(find(open_manager(args), args.name).password)
+
+
+def cmd_add(args: argparse.Namespace) -> None:
+    """Add a service with your own password."""
+    client = agent_client(args)
+    manager = None if client else open_manager(args)
+    password = new_password(f"Password of {args.name}: ", args)
+    if not password:
+        raise ValueError("Password cannot be empty!")
+    if client:
+        client.add(args.name, password)
+    else:
+        manager.add_service(args.name, password=password)
+
+
+def cmd_generate(args: argparse.Namespace) -> None:
+    """Add a service with a generated password and print it."""
+    options_given = any(value is not None for value in (args.length, args.lowercase, args.uppercase, args.numbers,
+                                                        args.specials, args.specials_to_use))
+    client = None if options_given else agent_client(args)
+    if client:
+        print(client.generate(args.name, args.policy))
+        return
+    from src.interface import Policy, Usage
+    manager = open_manager(args)
+    policy = manager.get_policy(args.policy)
+    if policy is None or options_given:
+        base = policy or Policy(args.policy)
+        options = {"length": args.length, "specials_to_use": args.specials_to_use}
+        for group in ("lowercase", "uppercase", "numbers", "specials"):
+            if getattr(args, group) is not None:
+                options[group] = Usage(usages.index(getattr(args, group)))
+        policy = base._replace(**{key: value for key, value in options.items() if value is not None})
+        if manager.changes_policy(policy) and not args.update_policy:
+            raise ValueError(f"Policy {args.policy} has other options, choose a new --policy name or pass"
+                             " --update-policy to change it!")
+    service = manager.add_service(args.name, policy=policy)
+    if service is None:
+        raise ValueError(f"Could not store service {args.name}!")
+    print(service.password)
+
+
+def cmd_rm(args: argparse.Namespace) -> None:
+    """Remove services."""
+    manager = open_manager(args)
+    ids = [find(manager, name).idx for name in args.names]
+    for message in manager.remove_services(ids).values():
+        print(message)
+
+
+def cmd_verify(args: argparse.Namespace) -> None:
+    """Check that services were not changed outside the application, all of them by default."""
+    manager = open_manager(args)
+    if args.names:
+        failed = [name for name in args.names if not manager.verify(find(manager, name).idx)]
+        if failed:
+            raise ValueError(f"Integrity check failed for {', '.join(failed)}!")
+        print("Services are intact.")
+        return
+    report = manager.audit(args.processes)
+    for idx in report.corrupted:
+        print(f"Service {idx} was changed outside the application.")
+    for idx in report.missing:
+        print(f"Service {idx} was removed outside the application.")
+    if not report.intact:
+        print("Integrity tree does not match its root.")
+    if not report.ok:
+        raise ValueError("Vault failed the integrity audit!")
+    print("Vault is intact.")
+
+
+def cmd_import(args: argparse.Namespace) -> None:
+    """Import a CSV or JSON export of another password manager."""
+    import src.importer as importer
+    manager = open_manager(args)
+    report = manager.import_services(importer.read(args.path))
+    for line, error in report.failures:
+        print(f"{args.path}:{line}: {error}", file=sys.stderr)
+    print(report)
+
+
+def cmd_export(args: argparse.Namespace) -> None:
+    """Write an encrypted backup protected by its own password."""
+    manager = open_manager(args)
+    manager.export(args.path, new_password("Backup password: ", args))
+
+
+def cmd_agent(args: argparse.Namespace) -> None:
+    """Unlock the vault once and serve the other commands from memory until idle for too long."""
+    import src.agent as agent
+    agent.serve(open_manager(args), idle_timeout=args.idle_timeout)
+
+
+def cmd_lock(args: argparse.Namespace) -> None:
+    """Stop the unlock agent."""
+    client = agent_client(args)
+    if not client:
+        raise ValueError("No agent is running!")
+    client.lock()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m src", description=__doc__)
+    parser.add_argument("--password-stdin", action="store_true",
+                        help="read the passwords from the standard input, one per line, instead of the terminal")
+    parser.add_argument("--no-agent", action="store_true", help="unlock the vault even if an agent is running")
+    parser.add_argument("--vault", metavar="PATH", help="vault file to use instead of the one in the project root")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ls_parser = commands.add_parser("ls", help=cmd_ls.__doc__)
+    ls_parser.add_argument("query", nargs="?")
+    ls_parser.set_defaults(run=cmd_ls)
+    get_parser = commands.add_parser("get", help=cmd_get.__doc__)
+    get_parser.add_argument("name")
+    get_parser.set_defaults(run=cmd_get)
+    add_parser = commands.add_parser("add", help=cmd_add.__doc__)
+    add_parser.add_argument("name")
+    add_parser.set_defaults(run=cmd_add)
+    generate_parser = commands.add_parser("generate", help=cmd_generate.__doc__)
+    generate_parser.add_argument("name")
+    generate_parser.add_argument("--policy", default=config.default_policy_name,
+                                 help="saved policy to use, or a new one the given options are saved as")
+    generate_parser.add_argument("--length", type=int)
+    for group in ("lowercase", "uppercase", "numbers", "specials"):
+        generate_parser.add_argument(f"--{group}", choices=usages)
+    generate_parser.add_argument("--specials-to-use", help="special symbols to pick from")
+    generate_parser.add_argument("--update-policy", action="store_true",
+                                 help="save other options into an existing policy, its services remember them")
+    generate_parser.set_defaults(run=cmd_generate)
+    rm_parser = commands.add_parser("rm", help=cmd_rm.__doc__)
+    rm_parser.add_argument("names", nargs="+")
+    rm_parser.set_defaults(run=cmd_rm)
+    verify_parser = commands.add_parser("verify", help=cmd_verify.__doc__)
+    verify_parser.add_argument("names", nargs="*")
+    verify_parser.add_argument("--processes", type=int, help="worker processes of the audit, one per CPU by default")
+    verify_parser.set_defaults(run=cmd_verify)
+    import_parser = commands.add_parser("import", help=cmd_import.__doc__)
+    import_parser.add_argument("path")
+    import_parser.set_defaults(run=cmd_import)
+    export_parser = commands.add_parser("export", help=cmd_export.__doc__)
+    export_parser.add_argument("path")
+    export_parser.set_defaults(run=cmd_export)
+    agent_parser = commands.add_parser("agent", help=cmd_agent.__doc__)
+    agent_parser.add_argument("--idle-timeout", type=float, default=config.agent_idle_timeout,
+                              help="seconds without a request after which the agent locks and exits")
+    agent_parser.set_defaults(run=cmd_agent)
+    lock_parser = commands.add_parser("lock", help=cmd_lock.__doc__)
+    lock_parser.set_defaults(run=cmd_lock)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+    try:
+        args.run(args)
+    except (ValueError, OSError) as e:
+        sys.exit(f"Error: {e}")
+    except KeyboardInterrupt:
+        sys.exit(1)
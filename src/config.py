@@ -2,8 +2,40 @@ seed_length: int = 128
 db_name: str = "pswdmngr.db"
 default_iterations: int = 30
 default_length: int = 16
-lowercase: str = "abcdefghijklmnopqrdtuvwxyz"
+lowercase: str = "abcdefghijklmnopqrstuvwxyz"
 uppercase: str = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 numbers: str = "0123456789"
 default_special_characters: str = "!\"#$%&'()*+,-./:;<=>?@[]^\\_`{|}~"
 auth_iterations: int = 300000
+kdf_algorithm: str = "scrypt"
+scrypt_n: int = 2 ** 17
+scrypt_r: int = 8
+scrypt_p: int = 1
+pbkdf2_iterations: int = 600000
+pbkdf2_hash: str = "sha256"
+scrypt_max_n: int = 2 ** 20
+calibrate_kdf: bool = True
+unlock_target: float = 0.5
+max_query_parameters: int = 900
+import_batch_size: int = 500
+export_chunk_size: int = 65536
+export_fetch_size: int = 256
+journal_mode: str = "WAL"
+synchronous: str = "NORMAL"
+busy_timeout: int = 5000
+pool_readers: int = 4
+lock_timeout: float = 10.0
+change_log_size: int = 10000
+change_poll_interval: int = 1000
+table_fetch_size: int = 256
+table_cache_size: int = 2048
+search_min_similarity: float = 0.5
+search_limit: int = 200
+use_directory: bool = True
+directory_bucket_size: int = 512
+random_block_size: int = 4096
+default_policy_name: str = "Default"
+agent_socket: str = ""
+agent_idle_timeout: float = 900.0
+agent_client_timeout: float = 5.0
+async_crypto_workers: int = 2
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import csv
+import json
+from pathlib import Path
+from typing import IO, Iterator, List, NamedTuple, Optional, Tuple
+
+name_columns = ("name", "title", "login_uri", "url")
+username_columns = ("username", "login_username", "user")
+password_columns = ("password", "login_password")
+
+
+class ImportRecord(NamedTuple):
+    """One service read from an export of another password manager. `line` points to the row of the source file,
+    `error` explains why the row cannot be imported."""
+
+    line: int
+    name: Optional[str]
+    password: Optional[str]
+    error: Optional[str] = None
+
+
+class ImportReport:
+    """Outcome of an import: number of stored services and the rows that were skipped."""
+
+    def __init__(self):
+        self.imported: int = 0
+        self.failures: List[Tuple[int, str]] = []
+
+    def __repr__(self):
+        return f"Imported {self.imported} services, {len(self.failures)} failed."
+
+
+def _pick(row: dict, columns: Tuple[str, ...]) -> Optional[str]:
+    for column in columns:
+        if row.get(column):
+            return row[column]
+    return None
+
+
+def _record(line: int, row: dict) -> ImportRecord:
+    """Normalizes one exported entry. The username becomes part of the name, as it is the only label we store."""
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+    name = _pick(row, name_columns)
+    password = _pick(row, password_columns)
+    username = _pick(row, username_columns)
+    if not name:
+        return ImportRecord(line, None, password, "Missing service name.")
+    if not password:
+        return ImportRecord(line, name, None, "Missing password.")
+    if username:
+        name = f"{name} ({username})"
+    return ImportRecord(line, name, password)
+
+
+def read_csv(stream: IO[str]) -> Iterator[ImportRecord]:
+    """Streams the rows of a CSV export. Understands the column names used by Bitwarden, KeePassXC, LastPass,
+    1Password and the browsers."""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield _record(reader.line_num, row)
+
+
+def read_json(stream: IO[str]) -> Iterator[ImportRecord]:
+    """Reads a JSON export: either Bitwarden's `{"items": [...]}` or a plain list of objects."""
+    data = json.load(stream)
+    items = data.get("items", []) if isinstance(data, dict) else data
+    for line, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            yield ImportRecord(line, None, None, "Not an object.")
+            continue
+        login = item.get("login")
+        if isinstance(login, dict):
+            uris = login.get("uris") or [{}]
+            item = dict(item, username=login.get("username"), password=login.get("password"),
+                        url=uris[0].get("uri") if isinstance(uris[0], dict) else None)
+        yield _record(line, item)
+
+
+def read(path: Path) -> Iterator[ImportRecord]:
+    """Streams the records of an export file, the format is picked by the file suffix."""
+    path = Path(path)
+    readers = {".csv": read_csv, ".json": read_json}
+    if path.suffix.lower() not in readers:
+        raise ValueError(f"Unsupported export format {path.suffix}!")
+    with open(path, newline="", encoding="utf-8-sig") as stream:
+        yield from readers[path.suffix.lower()](stream)
@@ -0,0 +1,185 @@
+"""Keyed integrity of the services. Every row carries a MAC of its contents, the MACs are the leaves of a sparse Merkle
+tree over the idx space and its root is kept in the `seeds` table.
+
+Leaf `idx` is the MAC of service `idx`, or `EMPTY` when there is none. Inner nodes are keyed hashes of their two
+children. The `merkle` table stores every node, leaves being level 0, that differs from the node of an empty
+subtree. A write recomputes the paths of the changed leaves, `depth` nodes each, and checking a single service
+against the root walks one path as well. A full audit splits the tree into aligned subtrees, every one checked by
+a worker process reading the database on its own."""
+from __future__ import annotations
+
+import hmac
+import math
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha3_256
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+EMPTY = bytes(32)
+
+
+class AuditReport(NamedTuple):
+    """Outcome of a full audit. `corrupted` services fail their MAC or do not match their leaf, `missing` ones have
+    a leaf but no row. `intact` tells whether the stored tree hashes up to the root."""
+    corrupted: List[int]
+    missing: List[int]
+    intact: bool
+
+    @property
+    def ok(self) -> bool:
+        return self.intact and not self.corrupted and not self.missing
+
+
+def integrity_key(token: bytes) -> bytes:
+    return hmac.new(token, b"service integrity", sha3_256).digest()
+
+
+def record_mac(key: bytes, row: tuple) -> bytes:
+    """MAC of `(idx, e_name, e_password, seed_name, seed_password, name_hmac)`. The idx is included, so a row cannot
+    be moved to another one."""
+    mac = hmac.new(key, b"\x00", sha3_256)
+    mac.update(row[0].to_bytes(8, "big"))
+    for field in row[1:6]:
+        # Text only ends up in a column when it was written by something else, it must not match the bytes it holds.
+        field = b"\x01" + field.encode("utf-8") if isinstance(field, str) else field or b""
+        mac.update(len(field).to_bytes(4, "big"))
+        mac.update(field)
+    return mac.digest()
+
+
+def node(key: bytes, level: int, left: bytes, right: bytes) -> bytes:
+    return hmac.new(key, bytes((1, level)) + left + right, sha3_256).digest()
+
+
+def empty_nodes(key: bytes, depth: int) -> List[bytes]:
+    """Node of an empty subtree for every level up to `depth`."""
+    nodes = [EMPTY]
+    for level in range(1, depth + 1):
+        nodes.append(node(key, level, nodes[-1], nodes[-1]))
+    return nodes
+
+
+def depth_for(idx: int) -> int:
+    """Depth of the smallest tree with a leaf for `idx`."""
+    return max(1, idx.bit_length())
+
+
+def _stored(cursor: sqlite3.Cursor, level: int, position: int) -> Optional[bytes]:
+    row = cursor.execute("SELECT hash FROM merkle WHERE level = ? AND position = ?;", (level, position)).fetchone()
+    return row[0] if row else None
+
+
+def update(cursor: sqlite3.Cursor, key: bytes, depth: int, leaves: Dict[int, bytes]) -> bytes:
+    """Stores the changed leaves, `EMPTY` for removed services, recomputes their paths level by level, so shared
+    ancestors are hashed once, and returns the new root."""
+    empty = empty_nodes(key, depth)
+    changed = dict(leaves)
+    for level in range(depth + 1):
+        for position, value in changed.items():
+            if value == empty[level]:
+                cursor.execute("DELETE FROM merkle WHERE level = ? AND position = ?;", (level, position))
+            else:
+                cursor.execute("INSERT OR REPLACE INTO merkle (level, position, hash) VALUES (?, ?, ?);",
+                               (level, position, value))
+        if level == depth:
+            break
+        parents = {}
+        for position in {position >> 1 for position in changed}:
+            children = []
+            for child in (2 * position, 2 * position + 1):
+                value = changed[child] if child in changed else _stored(cursor, level, child)
+                children.append(value or empty[level])
+            parents[position] = node(key, level + 1, *children)
+        changed = parents
+    return changed[0]
+
+
+def path_root(cursor: sqlite3.Cursor, key: bytes, depth: int, idx: int, leaf: bytes) -> bytes:
+    """Root computed from one leaf and the stored siblings along its path."""
+    empty = empty_nodes(key, depth)
+    value, position = leaf, idx
+    for level in range(depth):
+        sibling = _stored(cursor, level, position ^ 1) or empty[level]
+        children = (value, sibling) if position % 2 == 0 else (sibling, value)
+        value = node(key, level + 1, *children)
+        position >>= 1
+    return value
+
+
+def audit_block(path: str, key: bytes, level: int, block: int) -> Tuple[List[int], List[int], bool, bytes]:
+    """Checks the subtree `block` of height `level` against the records under it. Returns the corrupted and the
+    missing idx, whether the stored nodes are consistent, and the root of the subtree."""
+    first, last = block << level, ((block + 1) << level) - 1
+    connection = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+    # Columns changed to text that is not UTF-8 must be reported, not fail the audit.
+    connection.text_factory = bytes
+    try:
+        rows = connection.execute(
+            "SELECT idx, e_name, e_password, seed_name, seed_password, name_hmac, mac FROM services"
+            " WHERE idx BETWEEN ? AND ?;", (first, last)
+        ).fetchall()
+        stored = [dict(connection.execute(
+            "SELECT position, hash FROM merkle WHERE level = ? AND position BETWEEN ? AND ?;",
+            (height, first >> height, last >> height)
+        )) for height in range(level + 1)]
+    finally:
+        connection.close()
+    empty = empty_nodes(key, level)
+    leaves = stored[0]
+    corrupted = sorted(row[0] for row in rows if not row[6] or row[6] != leaves.get(row[0])
+                       or not hmac.compare_digest(row[6], record_mac(key, row)))
+    present = {row[0] for row in rows}
+    missing = sorted(idx for idx in leaves if idx not in present)
+    intact = True
+    nodes = leaves
+    for height in range(1, level + 1):
+        positions = {position >> 1 for position in nodes} | set(stored[height])
+        parents = {}
+        for position in positions:
+            value = node(key, height, nodes.get(2 * position, empty[height - 1]),
+                         nodes.get(2 * position + 1, empty[height - 1]))
+            if value != stored[height].get(position, empty[height]):
+                intact = False
+            if value != empty[height]:
+                parents[position] = value
+        nodes = parents
+    return corrupted, missing, intact, nodes.get(block, empty[level])
+
+
+def audit(path: Path, key: bytes, depth: int, root: bytes, processes: int = 1) -> AuditReport:
+    """Checks every service and the whole tree. The lower levels are split into aligned subtrees audited by
+    `processes` worker processes, the few levels above them are checked here."""
+    # A few subtrees per process, so an uneven one does not hold up the rest.
+    top = min(depth, math.ceil(math.log2(processes * 4)))
+    level = depth - top
+    blocks = range(1 << top)
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(audit_block, [str(path)] * len(blocks), [key] * len(blocks),
+                                        [level] * len(blocks), blocks))
+    else:
+        results = [audit_block(str(path), key, level, block) for block in blocks]
+    corrupted = sorted(idx for result in results for idx in result[0])
+    missing = sorted(idx for result in results for idx in result[1])
+    intact = all(result[2] for result in results)
+    empty = empty_nodes(key, depth)
+    nodes = {block: result[3] for block, result in zip(blocks, results) if result[3] != empty[level]}
+    connection = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        for height in range(level + 1, depth + 1):
+            stored = dict(connection.execute("SELECT position, hash FROM merkle WHERE level = ?;", (height,)))
+            parents = {}
+            for position in {position >> 1 for position in nodes} | set(stored):
+                value = node(key, height, nodes.get(2 * position, empty[height - 1]),
+                             nodes.get(2 * position + 1, empty[height - 1]))
+                if value != stored.get(position, empty[height]):
+                    intact = False
+                if value != empty[height]:
+                    parents[position] = value
+            nodes = parents
+    finally:
+        connection.close()
+    if not hmac.compare_digest(nodes.get(0, empty[depth]), root):
+        intact = False
+    return AuditReport(corrupted, missing, intact)
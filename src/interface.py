@@ -1,39 +1,80 @@
 from __future__ import annotations
 
 from enum import Enum
+from pathlib import Path
 
-from typing import List, Optional
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 import src.persistence as persistence
+import src.kdf as kdf
+import src.backup as backup
+import src.importer as importer
+import src.integrity as integrity
 from src import config as config
-from src.utils import rand_bytes, byte_cycling
+from src.utils import RandomBuffer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Generator:
     """Creates alphabet to which the cooked tokens will be translated. Ensures that there are present symbols from
     required groups."""
 
-    def __init__(self, alphabet: Alphabet, length: int):
+    def __init__(self, alphabet: Alphabet, length: int, randomness: Optional[RandomBuffer] = None):
+        if length < len(alphabet.groups):
+            raise ValueError("Password is too short to contain all the enforced groups!")
         self.alphabet = alphabet
         self.length = length
+        self.randomness = randomness or RandomBuffer()
+
+    def generate_password(self, length: Optional[int] = None) -> str:
+        """Draws one symbol of every enforced group and fills the rest from the whole pool. Shuffling afterwards
+        places the enforced symbols on uniformly random positions."""
+        length = self.length if length is None else length
+        if length < len(self.alphabet.groups):
+            raise ValueError("Password is too short to contain all the enforced groups!")
+        randbelow = self.randomness.randbelow
+        pool = self.alphabet.symbol_pool
+        symbols = [group[randbelow(len(group))] for group in self.alphabet.groups]
+        symbols += [pool[randbelow(len(pool))] for _ in range(length - len(symbols))]
+        self.randomness.shuffle(symbols)
+        return "".join(symbols)
+
+    def generate_many(self, n: int, length: Optional[int] = None) -> List[str]:
+        """Generates `n` passwords at once, vectorized when NumPy is installed. The randomness always comes from the
+        operating system, NumPy only does the arithmetic."""
+        length = self.length if length is None else length
+        if n < 0:
+            raise ValueError("Cannot generate a negative number of passwords!")
+        if length < len(self.alphabet.groups):
+            raise ValueError("Password is too short to contain all the enforced groups!")
+        if numpy is None or n == 0 or length == 0:
+            return [self.generate_password(length) for _ in range(n)]
+        columns = [group[self._uniform(len(group), n)] for group in self.alphabet.group_arrays]
+        pool = self.alphabet.pool_array
+        columns.append(pool[self._uniform(len(pool), n * (length - len(columns)))].reshape(n, -1))
+        symbols = numpy.column_stack(columns)
+        rows = numpy.arange(n)
+        # Fisher-Yates over all the passwords at once, one column at a time.
+        for i in range(length - 1, 0, -1):
+            j = self._uniform(i + 1, n)
+            symbols[rows, i], symbols[rows, j] = symbols[rows, j], symbols[rows, i]
+        return numpy.ascontiguousarray(symbols).view(f"<U{length}").ravel().tolist()
 
-    def generate_password(self) -> str:
-        """Maps bytes to a string output consisting of pre-selected symbols."""
-        unused_indices = [i for i in range(self.length)]
-        ans = {}
-        data = rand_bytes(2 * self.length)
-        iterator = byte_cycling(data)
-        for group in self.alphabet.groups:
-            position = unused_indices[next(iterator) % len(unused_indices)]
-            ans.update({position: group[next(iterator) % len(group)]})
-            unused_indices.remove(position)
-        for i in range(self.length - len(ans)):
-            position = unused_indices[next(iterator) % len(unused_indices)]
-            ans.update({position: self.alphabet.symbol_pool[next(iterator) % len(self.alphabet.symbol_pool)]})
-            unused_indices.remove(position)
-        password = ""
-        for i in range(self.length):
-            password += ans.get(i)
-        return password
+    def _uniform(self, bound: int, count: int):
+        """`count` uniform integers from [0, bound) as a NumPy array, rejection sampled from 16-bit values."""
+        if bound > 1 << 16:
+            raise ValueError("Upper bound is too large!")
+        limit = (1 << 16) - (1 << 16) % bound
+        accepted = numpy.empty(0, dtype=numpy.uint16)
+        while len(accepted) < count:
+            missing = count - len(accepted)
+            # Draw a bit more than the expected number of rejections so one round is almost always enough.
+            drawn = numpy.frombuffer(self.randomness.read(2 * (missing + missing // 8 + 16)), dtype=numpy.uint16)
+            accepted = numpy.concatenate((accepted, drawn[drawn < limit]))
+        return accepted[:count].astype(numpy.intp) % bound
 
 
 class Usage(Enum):
@@ -43,48 +84,115 @@ class Usage(Enum):
 
 
 class Alphabet:
-    def __init__(self, lowercase: Usage, uppercase: Usage, numbers: Usage, specials: Usage,
-                 specials_to_use: str = config.default_special_characters):
-        self.groups: List[str] = []
-        self.symbol_pool: str = ''
-        specials_to_use = ''.join(
-            filter(lambda x: True if x in config.default_special_characters else False, set(specials_to_use)))
-        if lowercase == Usage.ENFORCE:
-            self.groups.append(config.lowercase)
-            self.symbol_pool += config.lowercase
-        elif lowercase == Usage.ALLOW:
-            self.symbol_pool += config.lowercase
-        if uppercase == Usage.ENFORCE:
-            self.groups.append(config.uppercase)
-            self.symbol_pool += config.uppercase
-        elif uppercase == Usage.ALLOW:
-            self.symbol_pool += config.uppercase
-        if numbers == Usage.ENFORCE:
-            self.groups.append(config.numbers)
-            self.symbol_pool += config.numbers
-        elif numbers == Usage.ALLOW:
-            self.symbol_pool += config.numbers
-        if specials == Usage.ENFORCE:
-            self.groups.append(specials_to_use)
-            self.symbol_pool += specials_to_use
-        elif specials == Usage.ALLOW:
-            self.symbol_pool += specials_to_use
-        if len(self.symbol_pool) < 10:
+    """Compiled symbol tables of a password policy. Alphabets are immutable and cached by their options, so the
+    tables of every combination are built only once."""
+
+    __slots__ = ("usages", "specials_to_use", "groups", "symbol_pool", "group_arrays", "pool_array")
+    _compiled: Dict[Tuple[Usage, Usage, Usage, Usage, str], Alphabet] = {}
+
+    def __new__(cls, lowercase: Usage, uppercase: Usage, numbers: Usage, specials: Usage,
+                specials_to_use: str = config.default_special_characters):
+        usages = (Usage(lowercase), Usage(uppercase), Usage(numbers), Usage(specials))
+        specials_to_use = "".join(symbol for symbol in config.default_special_characters if symbol in specials_to_use)
+        if usages[3] == Usage.DISALLOW:
+            specials_to_use = ""
+        key = usages + (specials_to_use,)
+        if key not in cls._compiled:
+            cls._compiled[key] = cls._compile(usages, specials_to_use)
+        return cls._compiled[key]
+
+    @classmethod
+    def _compile(cls, usages: Tuple[Usage, Usage, Usage, Usage], specials_to_use: str) -> Alphabet:
+        groups = []
+        symbol_pool = ""
+        for usage, symbols in zip(usages, (config.lowercase, config.uppercase, config.numbers, specials_to_use)):
+            if usage == Usage.ENFORCE:
+                if not symbols:
+                    raise ValueError("Cannot enforce a group without symbols!")
+                groups.append(symbols)
+            if usage != Usage.DISALLOW:
+                symbol_pool += symbols
+        if len(symbol_pool) < 10:
             raise ValueError("This alphabet set would be too weak!")
+        alphabet = object.__new__(cls)
+        for attribute, value in (("usages", usages), ("specials_to_use", specials_to_use),
+                                 ("groups", tuple(groups)), ("symbol_pool", symbol_pool)):
+            object.__setattr__(alphabet, attribute, value)
+        if numpy is not None:
+            # Arrays the vectorized generator indexes directly.
+            object.__setattr__(alphabet, "group_arrays", tuple(numpy.array(list(group)) for group in groups))
+            object.__setattr__(alphabet, "pool_array", numpy.array(list(symbol_pool)))
+        return alphabet
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Alphabet is immutable!")
+
+    def __repr__(self):
+        return f"Alphabet({', '.join(usage.name for usage in self.usages)}, {self.specials_to_use!r})"
+
+
+class Policy(NamedTuple):
+    """Named set of password options stored in the vault. Services remember the policy they were generated by."""
+
+    name: str
+    length: int = config.default_length
+    lowercase: Usage = Usage.ENFORCE
+    uppercase: Usage = Usage.ENFORCE
+    numbers: Usage = Usage.ENFORCE
+    specials: Usage = Usage.ENFORCE
+    specials_to_use: str = config.default_special_characters
+
+    @property
+    def alphabet(self) -> Alphabet:
+        return Alphabet(self.lowercase, self.uppercase, self.numbers, self.specials, self.specials_to_use)
+
+    def generator(self) -> Generator:
+        return Generator(self.alphabet, self.length)
 
 
 class PasswordManager:
     """String-based interface for the application."""
 
-    def __init__(self, user_password: str):
+    def __init__(self, user_password: str, progress: Optional[kdf.Progress] = None,
+                 path: Optional[Union[str, Path]] = None):
+        """Unlocks the vault at `path`, by default the one in the project root, creating it on the first run."""
         if not isinstance(user_password, str):
             raise TypeError("Application password must be a string!")
-        self.persistence_manager = persistence.Persistence(user_password)
+        self.persistence_manager = persistence.Persistence(user_password, progress, path)
+
+    @classmethod
+    def from_persistence(cls, persistence_manager: persistence.Persistence) -> PasswordManager:
+        """Wraps a vault that was already unlocked by other means."""
+        manager = cls.__new__(cls)
+        manager.persistence_manager = persistence_manager
+        return manager
 
     @property
     def seed(self) -> bytes:
         return self.persistence_manager.seed
 
+    @property
+    def path(self) -> Path:
+        """File of the vault."""
+        return self.persistence_manager.path
+
+    def retune(self, user_password: str, target: float = config.unlock_target) -> str:
+        """Re-calibrates the unlock cost of the vault for this machine."""
+        derivation = self.persistence_manager.retune(user_password, kdf.calibrate(target=target))
+        return f"Unlock now uses {derivation}."
+
+    def lock(self) -> None:
+        """Drops the token and all decrypted data of the session."""
+        self.persistence_manager.lock()
+
+    def refresh(self) -> bool:
+        """Reloads the services changed by another process. Returns whether there were any."""
+        return self.persistence_manager.refresh()
+
+    def poll_changes(self) -> Optional[Set[int]]:
+        """Ids of the services changed by another process since the last call, None when all of them may have."""
+        return self.persistence_manager.poll_changes()
+
     @property
     def services(self) -> List[persistence.Service]:
         return self.persistence_manager.get_services()
@@ -92,18 +200,39 @@ class PasswordManager:
     def get_service(self, idx: int) -> Optional[persistence.Service]:
         return self.persistence_manager.get_service(idx)
 
+    def get_services_by_ids(self, ids: Iterable[int]) -> List[persistence.Service]:
+        return self.persistence_manager.get_services_by_ids(ids)
+
+    def find_service(self, name: str) -> Optional[persistence.Service]:
+        """Service with exactly this name, ignoring case and surrounding whitespace."""
+        return self.persistence_manager.find_service(name)
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[persistence.Service]:
+        """Services whose names match `query`, best first."""
+        return self.persistence_manager.search(query, limit)
+
+    def get_service_ids(self, after_idx: int = 0, limit: int = -1) -> List[int]:
+        return self.persistence_manager.get_service_ids(after_idx, limit)
+
+    def get_services_page(self, after_idx: int, limit: int) -> List[persistence.Service]:
+        return self.persistence_manager.get_services_page(after_idx, limit)
+
     def add_service(
             self,
             name: str,
             length: int = config.default_length,
             alphabet: Alphabet = Alphabet(Usage.ENFORCE, Usage.ENFORCE, Usage.ENFORCE,
                                           Usage.ENFORCE),
-            password: str = None
-    ) -> bool:
-        """Add a service."""
+            password: str = None,
+            policy: Optional[Policy] = None
+    ) -> Optional[persistence.Service]:
+        """Add a service. Returns it, or None when it could not be stored. With a `policy`, its options are used
+        instead of `length` and `alphabet`, the policy is saved and the service remembers it. A `password` given
+        together with a policy is taken as generated by it. A name that is already stored raises `ValueError`."""
         if password:
-            self.persistence_manager.add_service(name, password)
-            return True
+            return self._store_service(name, password, policy)
+        if policy is not None:
+            length, alphabet = policy.length, policy.alphabet
         if not isinstance(length, int):
             raise ValueError("Length must be instance of int!")
         if config.seed_length < 1:
@@ -111,8 +240,106 @@ class PasswordManager:
                 "There has to be at least some cryptographic salt!"
                 " src.config.seed_length must be grater than 0!"
             )
-        self.persistence_manager.add_service(name, Generator(alphabet, length).generate_password())
-        return True
+        password = Generator(alphabet, length).generate_password()
+        return self._store_service(name, password, policy)
+
+    def _store_service(self, name: str, password: str, policy: Optional[Policy]) -> Optional[persistence.Service]:
+        # One transaction, so a policy is not saved for a service refused because its name is taken.
+        with self.persistence_manager.transaction():
+            policy_idx = self.save_policy(policy) if policy is not None else None
+            return self.persistence_manager.add_service(name, password, policy_idx)
+
+    @property
+    def policies(self) -> List[Policy]:
+        """Saved policies, the last used first."""
+        return [Policy(row[1], row[2], Usage(row[3]), Usage(row[4]), Usage(row[5]), Usage(row[6]), row[7])
+                for row in self.persistence_manager.get_policies()]
+
+    def get_policy(self, name: str) -> Optional[Policy]:
+        for policy in self.policies:
+            if policy.name == name:
+                return policy
+        return None
+
+    def save_policy(self, policy: Policy) -> int:
+        """Stores a policy, replacing the one with the same name. Returns its idx."""
+        if not policy.name:
+            raise ValueError("Policy needs a name!")
+        if not isinstance(policy.length, int) or policy.length < 1:
+            raise ValueError("Length must be a positive int!")
+        alphabet = policy.alphabet
+        return self.persistence_manager.save_policy(
+            policy.name, policy.length, *(usage.value for usage in alphabet.usages), alphabet.specials_to_use
+        )
+
+    def changes_policy(self, policy: Policy) -> bool:
+        """Whether saving `policy` would change the options of the stored policy of the same name. The services it
+        generated before remember it, so `regenerate` would use options they were not generated with."""
+        saved = self.get_policy(policy.name)
+        if saved is None:
+            return False
+        return (saved.length, saved.alphabet) != (policy.length, policy.alphabet)
+
+    def regenerate(self, name: str) -> str:
+        """Replaces the passwords of all services generated by a policy with new ones, in a single transaction."""
+        policy = self.get_policy(name)
+        if policy is None:
+            raise ValueError(f"Policy {name} does not exist!")
+        ids = self.persistence_manager.get_policy_service_ids(name)
+        passwords = policy.generator().generate_many(len(ids))
+        count = self.persistence_manager.update_passwords(dict(zip(ids, passwords)))
+        return f"Regenerated {count} passwords."
+
+    def import_services(
+            self,
+            records: Iterable[importer.ImportRecord],
+            batch_size: int = config.import_batch_size,
+            progress: Optional[Callable[[int], None]] = None
+    ) -> importer.ImportReport:
+        """Stores services exported from another password manager, see `src.importer`. Everything is written in a
+        single transaction, rows that cannot be imported are listed in the report."""
+        report = importer.ImportReport()
+        seen = set()
+
+        def valid():
+            for record in records:
+                if record.error:
+                    report.failures.append((record.line, record.error))
+                    continue
+                name_hmac = self.persistence_manager.blind_index(record.name)
+                if name_hmac in seen or self.find_service(record.name):
+                    report.failures.append((record.line, "Service already exists."))
+                    continue
+                seen.add(name_hmac)
+                yield record.name, record.password
+
+        report.imported = self.persistence_manager.add_services(valid(), batch_size, progress)
+        return report
+
+    def export(self, path: Path, export_password: str) -> None:
+        """Writes an encrypted backup of all services, protected by its own password."""
+        if not isinstance(export_password, str) or len(export_password) < 8:
+            raise ValueError("Backup password is too short!")
+        with open(path, "wb") as stream:
+            self.persistence_manager.export_services(stream, export_password)
+
+    def restore(self, path: Path, export_password: str) -> str:
+        """Adds the services of a backup made by `export`. Like an import, services whose name is already stored are
+        skipped."""
+        with open(path, "rb") as stream:
+            records = (importer.ImportRecord(line, name, password)
+                       for line, (name, password) in enumerate(backup.read_records(stream, export_password), 1))
+            report = self.import_services(records)
+        return f"Restored {report.imported} services, skipped {len(report.failures)} already stored."
+
+    def verify(self, idx: int) -> bool:
+        """Whether a service is unchanged since the application stored it. Reads only its path of the integrity
+        tree."""
+        return self.persistence_manager.verify(idx)
+
+    def audit(self, processes: Optional[int] = None) -> integrity.AuditReport:
+        """Checks the integrity of every service in parallel worker processes and reports the bad ones by idx."""
+        return self.persistence_manager.audit(processes)
 
     def remove_service(self, idx: int) -> str:
         """Remove the service according to its name."""
@@ -123,3 +350,15 @@ class PasswordManager:
             return "Not found."
         return f"Successfully deleted service {service.name}."
 
+    def remove_services(self, ids: Iterable[int]) -> Dict[int, str]:
+        """Remove several services at once. Returns the outcome for every idx."""
+        ids = list(ids)
+        if not all(isinstance(idx, int) for idx in ids):
+            raise TypeError("Service idx must be an integer!")
+        names = {service.idx: service.name for service in self.get_services_by_ids(ids)}
+        results = self.persistence_manager.remove_services(ids)
+        return {
+            idx: f"Successfully deleted service {names[idx]}." if removed else "Not found."
+            for idx, removed in results.items()
+        }
+
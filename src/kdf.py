@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import json
+import time
+from functools import partial
+from hashlib import sha3_256, pbkdf2_hmac, scrypt
+from typing import Callable, Dict, Optional, Type
+
+import src.config as config
+
+token_length: int = 32
+
+Progress = Callable[[float], None]
+# Runs a derivation job somewhere, e.g. `lambda job: pool.submit(job).result()`, and returns its result.
+Runner = Callable[[Callable[[], bytes]], bytes]
+
+
+class Cancelled(Exception):
+    """Raised by a progress callback to abort the derivation."""
+
+
+class KDF:
+    """Key derivation function that turns the main password and the vault salt into the vault token.
+    Parameters are stored in the `seeds` table next to the salt, so every vault remembers how it was created."""
+
+    algorithm: str = ""
+    min_work: int = 1
+    max_work: Optional[int] = None
+
+    @property
+    def params(self) -> dict:
+        """Cost parameters of this derivation, stored as JSON in the database."""
+        raise NotImplementedError
+
+    @property
+    def work(self) -> int:
+        """The single cost parameter the derivation time grows linearly with."""
+        raise NotImplementedError
+
+    def with_work(self, work: int) -> KDF:
+        """Returns the same derivation with a different cost, clamped to the allowed range."""
+        raise NotImplementedError
+
+    def clamp(self, work: int) -> int:
+        work = max(work, self.min_work)
+        if self.max_work is not None:
+            work = min(work, self.max_work)
+        return work
+
+    def derive(self, user_password: str, seed: bytes, progress: Optional[Progress] = None) -> bytes:
+        """Derives `token_length` bytes from the main password and the salt. `progress` is called with the finished
+        fraction of the work and may raise `Cancelled` to stop it. Native derivations can only report their start
+        and end."""
+        raise NotImplementedError
+
+    def dumps(self) -> str:
+        return json.dumps(self.params, sort_keys=True)
+
+    def __repr__(self):
+        return f"{self.algorithm}({self.dumps()})"
+
+
+class Sha3Chain(KDF):
+    """Legacy derivation: SHA3-256 fed with its own digest many times in a Python loop.
+    Kept so the vaults created by older versions can still be opened."""
+
+    algorithm = "sha3-chain"
+    min_work = 100000
+
+    def __init__(self, iterations: int = config.auth_iterations):
+        if iterations < 1:
+            raise ValueError("Cannot perform less than 1 iteration!")
+        self.iterations = iterations
+
+    @property
+    def params(self) -> dict:
+        return {"iterations": self.iterations}
+
+    @property
+    def work(self) -> int:
+        return self.iterations
+
+    def with_work(self, work: int) -> Sha3Chain:
+        return Sha3Chain(self.clamp(work))
+
+    def derive(self, user_password: str, seed: bytes, progress: Optional[Progress] = None) -> bytes:
+        h = sha3_256()
+        h.update(seed + bytes(user_password, encoding="utf-8"))
+        digest = None
+        step = max(self.iterations // 100, 1)
+        for done in range(0, self.iterations, step):
+            if progress:
+                progress(done / self.iterations)
+            for i in range(min(step, self.iterations - done)):
+                digest = h.digest()
+                h.update(digest)
+        if progress:
+            progress(1.0)
+        return digest
+
+
+class Pbkdf2(KDF):
+    """PBKDF2-HMAC computed by OpenSSL."""
+
+    algorithm = "pbkdf2"
+    min_work = 100000
+
+    def __init__(self, iterations: int = config.pbkdf2_iterations, hash_name: str = config.pbkdf2_hash):
+        if iterations < 1:
+            raise ValueError("Cannot perform less than 1 iteration!")
+        self.iterations = iterations
+        self.hash_name = hash_name
+
+    @property
+    def params(self) -> dict:
+        return {"iterations": self.iterations, "hash_name": self.hash_name}
+
+    @property
+    def work(self) -> int:
+        return self.iterations
+
+    def with_work(self, work: int) -> Pbkdf2:
+        return Pbkdf2(self.clamp(work), self.hash_name)
+
+    def derive(self, user_password: str, seed: bytes, progress: Optional[Progress] = None) -> bytes:
+        if progress:
+            progress(0.0)
+        digest = pbkdf2_hmac(self.hash_name, bytes(user_password, encoding="utf-8"), seed, self.iterations,
+                             dklen=token_length)
+        if progress:
+            progress(1.0)
+        return digest
+
+
+class Scrypt(KDF):
+    """Memory-hard scrypt computed by OpenSSL."""
+
+    algorithm = "scrypt"
+    min_work = 2 ** 14
+    max_work = config.scrypt_max_n
+
+    def __init__(self, n: int = config.scrypt_n, r: int = config.scrypt_r, p: int = config.scrypt_p):
+        if n < 2 or n & (n - 1):
+            raise ValueError("Scrypt cost `n` must be a power of 2 greater than 1!")
+        if r < 1 or p < 1:
+            raise ValueError("Scrypt parameters `r` and `p` must be positive!")
+        self.n = n
+        self.r = r
+        self.p = p
+
+    @property
+    def params(self) -> dict:
+        return {"n": self.n, "r": self.r, "p": self.p}
+
+    @property
+    def work(self) -> int:
+        return self.n
+
+    def with_work(self, work: int) -> Scrypt:
+        # `n` has to be a power of 2, take the largest one that still fits the requested cost.
+        n = 1 << (max(self.clamp(work), 2).bit_length() - 1)
+        return Scrypt(max(n, self.min_work), self.r, self.p)
+
+    def derive(self, user_password: str, seed: bytes, progress: Optional[Progress] = None) -> bytes:
+        if progress:
+            progress(0.0)
+        # OpenSSL refuses to allocate more than 32 MiB unless told otherwise.
+        maxmem = 128 * self.r * (self.n + self.p + 2) + 1024 * 1024
+        digest = scrypt(bytes(user_password, encoding="utf-8"), salt=seed, n=self.n, r=self.r, p=self.p,
+                        maxmem=maxmem, dklen=token_length)
+        if progress:
+            progress(1.0)
+        return digest
+
+
+def run(derivation: KDF, user_password: str, seed: bytes, progress: Optional[Progress] = None,
+        runner: Optional[Runner] = None) -> bytes:
+    """Derives the key on the calling thread, or through `runner` when given. Without `progress` the job `runner`
+    gets can be pickled, so it may run in another process."""
+    if runner is None:
+        return derivation.derive(user_password, seed, progress)
+    return runner(partial(derivation.derive, user_password, seed, progress))
+
+
+algorithms: Dict[str, Type[KDF]] = {kdf.algorithm: kdf for kdf in (Sha3Chain, Pbkdf2, Scrypt)}
+
+
+def load(algorithm: Optional[str], params: Optional[str], iterations: Optional[int] = None) -> KDF:
+    """Creates the KDF described by a row of the `seeds` table. Rows without an algorithm come from the legacy
+    vaults and only have their iteration count."""
+    if not algorithm:
+        return Sha3Chain(iterations)
+    if algorithm not in algorithms:
+        raise ValueError(f"Unknown key derivation algorithm {algorithm}!")
+    return algorithms[algorithm](**json.loads(params or "{}"))
+
+
+def default() -> KDF:
+    """KDF used for newly created vaults."""
+    if config.kdf_algorithm not in algorithms:
+        raise ValueError(f"Unknown key derivation algorithm {config.kdf_algorithm}!")
+    return algorithms[config.kdf_algorithm]()
+
+
+def calibrate(algorithm: str = config.kdf_algorithm, target: float = config.unlock_target) -> KDF:
+    """Measures how fast this machine runs `algorithm` and returns its parameters scaled so the derivation takes
+    about `target` seconds. The cost never drops below the algorithm's minimum."""
+    if algorithm not in algorithms:
+        raise ValueError(f"Unknown key derivation algorithm {algorithm}!")
+    if target <= 0:
+        raise ValueError("Target unlock time must be positive!")
+    derivation = algorithms[algorithm]()
+    probe = derivation.with_work(derivation.min_work)
+    seed = bytes(16)
+    # Keep doubling the cost until the measurement is long enough not to be dominated by noise.
+    while True:
+        start = time.perf_counter()
+        probe.derive("calibration", seed)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min(target / 4, 0.05) or probe.work == probe.max_work:
+            break
+        probe = probe.with_work(probe.work * 2)
+    return derivation.with_work(int(probe.work * target / max(elapsed, 1e-9)))
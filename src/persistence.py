@@ -1,9 +1,23 @@
 from __future__ import annotations
 import sqlite3
-from typing import List, Optional
-from src.utils import get_project_root, rand_bytes
-from src.config import seed_length, db_name, auth_iterations
-from hashlib import sha3_512, sha3_256, sha3_384
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from src.utils import rand_bytes, normalize_name, vault_path
+from src.config import seed_length, calibrate_kdf, max_query_parameters, import_batch_size, \
+    export_chunk_size, export_fetch_size, use_directory, directory_bucket_size, change_log_size
+import hmac
+import json
+import os
+import time
+import zlib
+from hashlib import sha3_512, sha3_384, sha3_256
+import src.kdf as kdf
+import src.backup as backup
+import src.integrity as integrity
+from src.pool import ConnectionPool, retry
+from src.search import NameIndex
 
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
@@ -37,18 +51,18 @@ class Service:
         cipher = AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
         return unpad(cipher.decrypt(self.encrypted_password), 16).decode('utf-8')
 
-    def change_name(self, name: str) -> bool:
+    def change_name(self, name: str) -> None:
         self.name = name
-        return self.save()
+        self.save()
 
-    def change_password(self, password: str) -> bool:
+    def change_password(self, password: str) -> None:
         noise_source = sha3_384()
         noise_source.update(self.persistence_manager.token)
         noise_source.update(self.seed_password)
         digest = noise_source.digest()
         cipher = AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
         self.encrypted_password = cipher.encrypt(pad(bytes(password, encoding='utf-8'), 16))
-        return self.save()
+        self.save()
 
     def encrypt(self) -> EncryptedService:
         noise_source = sha3_384()
@@ -58,23 +72,29 @@ class Service:
         cipher = AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
         e_name = cipher.encrypt(pad(bytes(self.name, encoding='utf-8'), 16))
         return EncryptedService(self.idx, e_name, self.encrypted_password, self.seed_name, self.seed_password,
-                                self.persistence_manager)
+                                self.persistence_manager, self.persistence_manager.blind_index(self.name))
 
-    def save(self) -> bool:
-        return self.encrypt().save()
+    def save(self) -> None:
+        e_service = self.encrypt()
+        with self.persistence_manager.transaction():
+            e_service.save()
+            self.idx = e_service.idx
+            self.persistence_manager.cache_service(self)
 
 
 class EncryptedService:
     """Encrypted service and its IVs."""
 
     def __init__(self, idx: int, e_name: bytes, e_password: bytes, seed_name: bytes, seed_password: bytes,
-                 persistence_manager: Persistence):
+                 persistence_manager: Persistence, name_hmac: Optional[bytes] = None, policy: Optional[int] = None):
         self.idx = idx
         self.e_name = e_name
         self.e_password = e_password
         self.seed_name = seed_name
         self.seed_password = seed_password
         self.persistence_manager = persistence_manager
+        self.name_hmac = name_hmac
+        self.policy = policy
 
     def decrypt(self, persistence_manager: Persistence) -> Service:
         """Creates Service from EncryptedService."""
@@ -86,61 +106,317 @@ class EncryptedService:
         name = unpad(cipher.decrypt(self.e_name), 16).decode('utf-8')
         return Service(self.idx, name, self.e_password, self.seed_name, self.seed_password, persistence_manager)
 
-    def save(self) -> bool:
-        idx = self.persistence_manager.cursor.execute("SELECT idx FROM services WHERE idx = ?", (self.idx,)).fetchone()
-        if not self.idx or not idx:
-            try:
-                self.persistence_manager.cursor.execute(
-                    "INSERT INTO services (e_name, e_password, seed_name, seed_password) VALUES (?, ?, ?, ?);",
-                    (self.e_name, self.e_password, self.seed_name, self.seed_password)
+    def save(self) -> None:
+        """Inserts or updates the service. A vault kept busy by other processes for too long raises `ValueError`,
+        other database errors propagate as well."""
+        with self.persistence_manager.transaction() as cursor:
+            idx = cursor.execute("SELECT idx FROM services WHERE idx = ?", (self.idx,)).fetchone()
+            if not self.idx or not idx:
+                cursor.execute(
+                    "INSERT INTO services (e_name, e_password, seed_name, seed_password, name_hmac, policy)"
+                    " VALUES (?, ?, ?, ?, ?, ?);",
+                    (self.e_name, self.e_password, self.seed_name, self.seed_password, self.name_hmac,
+                     self.policy)
                 )
-                self.persistence_manager.conn.commit()
-                return True
-            except sqlite3.Error:
-                return False
-        else:
-            try:
-                self.persistence_manager.cursor.execute("UPDATE services SET e_name = ?, e_password = ?, seed_name = ?,"
-                                                        " seed_password = ? WHERE idx = ?;",
-                                                        (self.e_name, self.e_password, self.seed_name,
-                                                         self.seed_password, self.idx))
-                return True
-            except sqlite3.Error:
-                return False
+                self.idx = cursor.lastrowid
+            else:
+                cursor.execute("UPDATE services SET e_name = ?, e_password = ?, seed_name = ?,"
+                               " seed_password = ?, name_hmac = ? WHERE idx = ?;",
+                               (self.e_name, self.e_password, self.seed_name, self.seed_password,
+                                self.name_hmac, self.idx))
 
 
 class Persistence:
     """Communication with the database. Needs main password to decrypt the database."""
 
-    def __init__(self, user_password: str):
-        if not db_name:
-            self.conn = sqlite3.connect(get_project_root() / "pswdmngr.db")
-        else:
-            self.conn = sqlite3.connect(get_project_root() / db_name)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS seeds (seed BLOB, iterations INT, controlhash BLOB);"
-        )
-        if not self.seed:
-            self.set_password(user_password)
+    def __init__(self, user_password: Optional[str] = None, progress: Optional[kdf.Progress] = None,
+                 path: Optional[Union[str, Path]] = None):
+        """Opens the database at `path`, by default the one in the project root, and unlocks it when
+        `user_password` is given. See `unlock` otherwise. The file is created if it does not exist."""
+        # Any thread may use the vault: reads borrow one of the pooled read-only connections, writes wait for the
+        # single writer. `_cache_lock` guards the session cache below; it is never held while waiting for the writer.
+        self.path = vault_path(path)
+        self.pool = ConnectionPool(self.path)
+        self._transaction_depth = 0
+        self._cache_lock = threading.RLock()
         self.token: bytes = None
-        self.init_token(user_password)
+        # Decrypted services of this session, keyed by idx. `_all_cached` tells whether it holds the whole vault.
+        self._services: Dict[int, Service] = {}
+        self._all_cached = False
+        # Search index over the decrypted names, built on the first search of the session.
+        self.name_index: Optional[NameIndex] = None
+        # Names from the directory, see `_directory_names`. `_directory_buckets` changed since it was saved, None
+        # when all of them have to be written.
+        self._directory: Optional[Dict[int, str]] = None
+        self._directory_checked = False
+        self._directory_buckets: Optional[Set[int]] = set()
+        self._directory_dirty = False
+        # Last entry of the change log and data version the session cache was brought up to, see `poll_changes`.
+        self._last_change: Optional[int] = None
+        self._data_version: Optional[int] = None
+        # Last change log entry whose service has its MAC and path in the integrity tree updated, see `_seal`.
+        self._sealed_through: Optional[int] = None
+        with self.transaction() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS seeds (seed BLOB, iterations INT, controlhash BLOB, algorithm TEXT,"
+                " params TEXT, wrapped_token BLOB, generation INTEGER DEFAULT 0);"
+            )
+            self._add_columns(cursor, "seeds", (("algorithm", "TEXT"), ("params", "TEXT"),
+                                                ("wrapped_token", "BLOB"), ("generation", "INTEGER DEFAULT 0"),
+                                                ("merkle_root", "BLOB"), ("merkle_depth", "INTEGER"),
+                                                ("directory_generation", "INTEGER")))
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS services"
+                " (idx INTEGER PRIMARY KEY AUTOINCREMENT, e_name BLOB, e_password BLOB,"
+                " seed_name BLOB, seed_password BLOB, name_hmac BLOB, policy INTEGER, mac BLOB);"
+            )
+            self._add_columns(cursor, "services", (("name_hmac", "BLOB"), ("policy", "INTEGER"), ("mac", "BLOB")))
+            cursor.execute("CREATE INDEX IF NOT EXISTS services_name_hmac ON services (name_hmac);")
+            cursor.execute("CREATE INDEX IF NOT EXISTS services_policy ON services (policy);")
+            # Password options, not secret. `used` orders them by the last time they were saved.
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS policies"
+                " (idx INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, length INTEGER,"
+                " lowercase INTEGER, uppercase INTEGER, numbers INTEGER, specials INTEGER, specials_to_use TEXT,"
+                " used REAL);"
+            )
+            # Every change of the services, made by any version of the application, bumps the generation.
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                cursor.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS services_generation_{event.lower()} AFTER {event} ON services"
+                    " BEGIN UPDATE seeds SET generation = generation + 1; END;"
+                )
+            # Names of the services in buckets of `directory_bucket_size` ids, see `_directory_names`. Replaces the
+            # single record of earlier versions.
+            cursor.execute("DROP TABLE IF EXISTS directory;")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS directory_buckets (bucket INTEGER PRIMARY KEY, seed BLOB, blob BLOB);"
+            )
+            # Nodes of the integrity tree, see `src.integrity`.
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS merkle (level INTEGER, position INTEGER, hash BLOB NOT NULL,"
+                " PRIMARY KEY (level, position)) WITHOUT ROWID;"
+            )
+            # Log of the changed services, so other processes reload only those. Trimmed on every commit.
+            cursor.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, idx INTEGER);")
+            for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                cursor.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS services_changes_{event.lower()} AFTER {event} ON services"
+                    f" BEGIN INSERT INTO changes (idx) VALUES ({row}.idx); END;"
+                )
+            self._data_version = self.pool.data_version()
+            self._last_change = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM changes;").fetchone()[0]
+        if user_password is not None:
+            self.unlock(user_password, progress)
 
-        self.cursor.execute(
-            "CREATE TABLE IF NOT EXISTS services"
-            " (idx INTEGER PRIMARY KEY AUTOINCREMENT, e_name BLOB, e_password BLOB,"
-            " seed_name BLOB, seed_password BLOB);"
-        )
-        self.conn.commit()
+    def unlock(self, user_password: str, progress: Optional[kdf.Progress] = None,
+               run_kdf: Optional[kdf.Runner] = None) -> None:
+        """Derives the token, creating the vault on the first run. `run_kdf` may run the derivation elsewhere, like
+        on a thread pool."""
+        if not self.seed:
+            self.set_password(user_password, progress=progress, run_kdf=run_kdf)
+        else:
+            self.init_token(user_password, progress, run_kdf)
+        self._fill_blind_index()
+        self._init_integrity()
+
+    def _seal(self, cursor: sqlite3.Cursor, ids: Iterable[int] = ()) -> None:
+        """Updates the MACs and the integrity tree for `ids` and the services changed in this transaction since the
+        last seal."""
+        seeds = cursor.execute("SELECT merkle_root, merkle_depth FROM seeds;").fetchone()
+        if not seeds or seeds[0] is None:
+            return
+        ids = set(ids)
+        ids.update(row[0] for row in cursor.execute("SELECT idx FROM changes WHERE seq > ?;", (self._sealed_through,)))
+        if not ids:
+            return
+        key = integrity.integrity_key(self.token)
+        leaves = dict.fromkeys(ids, integrity.EMPTY)
+        for row in self._select_ids(
+            "SELECT idx, e_name, e_password, seed_name, seed_password, name_hmac FROM services WHERE idx IN ({ids});",
+            ids, cursor
+        ):
+            leaves[row[0]] = integrity.record_mac(key, row)
+        cursor.executemany("UPDATE services SET mac = ? WHERE idx = ?;",
+                           ((mac, idx) for idx, mac in leaves.items() if mac != integrity.EMPTY))
+        depth = max(seeds[1], integrity.depth_for(max(leaves)))
+        cursor.execute("UPDATE seeds SET merkle_root = ?, merkle_depth = ?;",
+                       (integrity.update(cursor, key, depth, leaves), depth))
+        # Setting the MACs logged the services once more, they are sealed already.
+        self._sealed_through = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM changes;").fetchone()[0]
+
+    def _init_integrity(self) -> None:
+        """Seals every service of vaults created before the integrity checks, or an empty new vault."""
+        if self._fetch_one("SELECT merkle_root FROM seeds;")[0] is not None:
+            return
+        with self.transaction() as cursor:
+            if cursor.execute("SELECT merkle_root FROM seeds;").fetchone()[0] is not None:
+                return
+            key = integrity.integrity_key(self.token)
+            cursor.execute("DELETE FROM merkle;")
+            cursor.execute("UPDATE seeds SET merkle_root = ?, merkle_depth = 1;", (integrity.empty_nodes(key, 1)[1],))
+            self._seal(cursor, [row[0] for row in cursor.execute("SELECT idx FROM services;").fetchall()])
+
+    def verify(self, idx: int) -> bool:
+        """Checks one service against its MAC and the root of the integrity tree. Reads only the nodes on its path,
+        so it is cheap enough to run after every write."""
+        if self.token is None:
+            raise ValueError("Vault is locked!")
+        with self._snapshot() as connection:
+            row = connection.execute(
+                "SELECT idx, e_name, e_password, seed_name, seed_password, name_hmac, mac FROM services WHERE idx = ?;",
+                (idx,)
+            ).fetchone()
+            root, depth = connection.execute("SELECT merkle_root, merkle_depth FROM seeds;").fetchone()
+            if row is None or root is None or not row[6]:
+                return False
+            key = integrity.integrity_key(self.token)
+            if not hmac.compare_digest(row[6], integrity.record_mac(key, row)):
+                return False
+            return hmac.compare_digest(integrity.path_root(connection.cursor(), key, depth, idx, row[6]), root)
+
+    def audit(self, processes: Optional[int] = None) -> integrity.AuditReport:
+        """Checks every service and the whole integrity tree on `processes` worker processes, one per CPU by
+        default. Writers wait until it is done."""
+        with self.pool.writing():
+            root, depth = self._fetch_one("SELECT merkle_root, merkle_depth FROM seeds;")
+            if root is None or self.token is None:
+                raise ValueError("Vault is locked!")
+            return integrity.audit(self.path, integrity.integrity_key(self.token), depth, root,
+                                   processes or os.cpu_count() or 1)
 
     def __del__(self):
-        self.conn.close()
+        if hasattr(self, "pool"):
+            self.pool.close()
+
+    @contextmanager
+    def transaction(self, wait: bool = True) -> Iterator[sqlite3.Cursor]:
+        """Groups writes into a single atomic transaction with one commit. Nested calls join the outer transaction,
+        other threads and processes wait until it ends, or raise `ValueError` without `wait`. On error everything is
+        rolled back and the session cache is dropped, as it may hold the discarded writes."""
+        with self.pool.writing(wait) as connection:
+            if self._transaction_depth:
+                self._transaction_depth += 1
+                try:
+                    yield connection.cursor()
+                finally:
+                    self._transaction_depth -= 1
+                return
+            cursor = connection.cursor()
+            retry(lambda: cursor.execute("BEGIN IMMEDIATE;"))
+            self._transaction_depth = 1
+            try:
+                # Catch up with the other processes first, the directory we may save has to include their changes.
+                if self._last_change is not None:
+                    self.poll_changes()
+                self._sealed_through = self._last_change
+                # The directory has to be read before our writes bump the generation.
+                if self.token:
+                    self._directory_names()
+                yield cursor
+                if self._sealed_through is not None and self.token:
+                    self._seal(cursor)
+                if self._directory_dirty:
+                    self._save_directory(cursor)
+                last_change = self._last_change
+                if last_change is not None:
+                    cursor.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?;",
+                                   (change_log_size,))
+                    # Our own changes are in the session cache already.
+                    last_change = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM changes;").fetchone()[0]
+            except BaseException:
+                self._transaction_depth = 0
+                cursor.execute("ROLLBACK;")
+                self._drop_cache()
+                raise
+            self._transaction_depth = 0
+            cursor.execute("COMMIT;")
+            self._last_change = last_change
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[sqlite3.Connection]:
+        """Connection reading a single consistent state of the database."""
+        with self.pool.reader() as connection:
+            if connection.in_transaction:
+                yield connection
+                return
+            retry(lambda: connection.execute("BEGIN;"))
+            try:
+                yield connection
+            finally:
+                connection.execute("COMMIT;")
+
+    def _fetch_one(self, sql: str, parameters: Iterable = ()) -> Optional[tuple]:
+        with self.pool.reader() as connection:
+            return retry(lambda: connection.execute(sql, tuple(parameters)).fetchone())
+
+    def _fetch_all(self, sql: str, parameters: Iterable = ()) -> List[tuple]:
+        with self.pool.reader() as connection:
+            return retry(lambda: connection.execute(sql, tuple(parameters)).fetchall())
+
+    def _select_ids(self, sql: str, ids: Iterable[int], cursor: Optional[sqlite3.Cursor] = None) -> List[tuple]:
+        """Runs `sql` for the ids bound in place of `{ids}` and returns all rows. SQLite limits the number of bound
+        parameters of one statement, so long lists are split. Uses `cursor` inside a transaction, a reader
+        otherwise."""
+        ids = list(ids)
+        rows: List[tuple] = []
+        for start in range(0, len(ids), max_query_parameters):
+            chunk = ids[start:start + max_query_parameters]
+            statement = sql.format(ids=", ".join("?" * len(chunk)))
+            rows.extend(cursor.execute(statement, chunk).fetchall() if cursor else self._fetch_all(statement, chunk))
+        return rows
+
+    def _decrypt_row(self, row: tuple) -> Service:
+        """Service from a `(idx, e_name, e_password, seed_name, seed_password)` row."""
+        return EncryptedService(row[0], row[1], row[2], row[3], row[4], self).decrypt(self)
+
+    @staticmethod
+    def _add_columns(cursor: sqlite3.Cursor, table: str, columns: Tuple[Tuple[str, str], ...]) -> None:
+        """Adds the columns missing in the tables of vaults created by older versions."""
+        existing = [row[1] for row in cursor.execute(f"PRAGMA table_info({table});")]
+        for column, column_type in columns:
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type};")
+
+    def blind_index(self, name: str) -> bytes:
+        """Keyed hash of the normalized service name. Lets the database find a service by its name without being
+        able to tell the name itself."""
+        key = hmac.new(self.token, b"service name index", sha3_256).digest()
+        return hmac.new(key, bytes(normalize_name(name), encoding='utf-8'), sha3_256).digest()
+
+    def _fill_blind_index(self) -> None:
+        """Computes the blind index of services stored by older versions."""
+        rows = self._fetch_all(
+            "SELECT idx, e_name, e_password, seed_name, seed_password FROM services WHERE name_hmac IS NULL;"
+        )
+        if not rows:
+            return
+        with self.transaction() as cursor:
+            for row in rows:
+                service = self._decrypt_row(row)
+                cursor.execute("UPDATE services SET name_hmac = ? WHERE idx = ?;",
+                               (self.blind_index(service.name), service.idx))
+
+    def find_service(self, name: str) -> Optional[Service]:
+        """Looks a service up by its exact (normalized) name using the blind index. Vaults of older versions may
+        store a name twice, the oldest service wins."""
+        row = self._fetch_one(
+            "SELECT idx, e_name, e_password, seed_name, seed_password FROM services WHERE name_hmac = ?"
+            " ORDER BY idx LIMIT 1;",
+            (self.blind_index(name),)
+        )
+        if not row:
+            return None
+        service = self._services.get(row[0])
+        if service is None:
+            service = self._services.setdefault(row[0], self._decrypt_row(row))
+        return service
 
     @property
     def seed(self) -> Optional[bytes]:
         """Returns salt used for db encryption purposes. This salt is combined with the main password, hashed many
         times and the out-coming mess is used as the db encryption key."""
-        seed = self.cursor.execute("SELECT seed FROM seeds;").fetchone()
+        seed = self._fetch_one("SELECT seed FROM seeds;")
         if not seed:
             return None
         else:
@@ -148,23 +424,265 @@ class Persistence:
         return seed
 
     def get_services(self) -> List[Service]:
-        """Get decrypted services and their recipes."""
-        ans: List[Service] = []
-        for row in self.cursor.execute("SELECT idx, e_name, e_password, seed_name, seed_password FROM services;"):
-            e_service = EncryptedService(row[0], row[1], row[2], row[3], row[4], self)
-            service = e_service.decrypt(self)
-            ans.append(service)
-        return ans
+        """Get decrypted services and their recipes. Only the first call of the session decrypts them, and with
+        a valid directory record even that is a single decryption."""
+        if not self._all_cached:
+            names = self._directory_names()
+            rows = self._fetch_all("SELECT idx, e_name, e_password, seed_name, seed_password FROM services;")
+            if names is not None and len(names) == len(rows) and all(row[0] in names for row in rows):
+                with self._cache_lock:
+                    for row in rows:
+                        if row[0] not in self._services:
+                            self._services[row[0]] = Service(row[0], names[row[0]], row[2], row[3], row[4], self)
+                    self._all_cached = True
+            else:
+                self._decrypt_rows(rows)
+                if use_directory:
+                    self._rebuild_directory()
+        with self._cache_lock:
+            services = list(self._services.values())
+        return sorted(services, key=lambda service: service.idx)
+
+    def _rebuild_directory(self) -> None:
+        """Replaces a missing or stale directory with the names of the session cache, which has to hold all services.
+        It is written right away unless another writer is busy, the next write of the session saves it then."""
+        with self._cache_lock:
+            self._directory = {idx: service.name for idx, service in self._services.items()}
+            self._directory_checked = True
+            self._directory_buckets = None
+            self._directory_dirty = True
+        try:
+            with self.transaction(wait=False):
+                pass
+        except ValueError:
+            pass
+
+    def _decrypt_rows(self, rows: List[tuple]) -> None:
+        """Decrypts the rows missing in the session cache one by one, `rows` have to be all the services."""
+        with self._cache_lock:
+            for row in rows:
+                if row[0] not in self._services:
+                    self._services[row[0]] = self._decrypt_row(row)
+            self._all_cached = True
+
+    def _directory_cipher(self, seed: bytes):
+        noise_source = sha3_384()
+        noise_source.update(self.token)
+        noise_source.update(seed)
+        digest = noise_source.digest()
+        return AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
+
+    def _directory_names(self) -> Optional[Dict[int, str]]:
+        """Names of all services from the directory: encrypted, compressed blobs mapping idx to name, one per bucket
+        of `directory_bucket_size` ids. Read once per session. None when the directory is turned off, missing,
+        damaged, or stale because somebody changed the services without updating it."""
+        with self._cache_lock:
+            if not use_directory or self._directory_checked:
+                return self._directory
+            self._directory_checked = True
+            with self._snapshot() as connection:
+                if not connection.execute("SELECT directory_generation = generation FROM seeds;").fetchone()[0]:
+                    return None
+                rows = connection.execute("SELECT seed, blob FROM directory_buckets;").fetchall()
+            directory = {}
+            try:
+                for seed, blob in rows:
+                    data = zlib.decompress(unpad(self._directory_cipher(seed).decrypt(blob), 16))
+                    directory.update((int(idx), name) for idx, name in json.loads(data).items())
+            except (ValueError, TypeError, AttributeError, zlib.error):
+                # The directory is only a cache, a damaged one is rebuilt from the services like a missing one.
+                return None
+            self._directory = directory
+            return self._directory
+
+    def _touch_directory(self, ids: Iterable[int]) -> None:
+        """Marks the buckets of changed services to be written with the transaction. Needs `_cache_lock`."""
+        if self._directory is None:
+            return
+        if self._directory_buckets is not None:
+            self._directory_buckets.update(idx // directory_bucket_size for idx in ids)
+        self._directory_dirty = True
+
+    def _save_directory(self, cursor: sqlite3.Cursor) -> None:
+        """Writes the changed buckets of the directory and stamps it with the generation of the services it
+        describes, so a write costs the size of a bucket and not of the vault."""
+        with self._cache_lock:
+            if self._directory is None:
+                self._directory_dirty = False
+                return
+            if self._directory_buckets is None:
+                cursor.execute("DELETE FROM directory_buckets;")
+                buckets = {idx // directory_bucket_size for idx in self._directory}
+            else:
+                buckets = self._directory_buckets
+            contents = {bucket: {idx: self._directory[idx]
+                                 for idx in range(bucket * directory_bucket_size, (bucket + 1) * directory_bucket_size)
+                                 if idx in self._directory}
+                        for bucket in buckets}
+            self._directory_buckets = set()
+            self._directory_dirty = False
+        for bucket, names in contents.items():
+            if not names:
+                cursor.execute("DELETE FROM directory_buckets WHERE bucket = ?;", (bucket,))
+                continue
+            seed = rand_bytes(32)
+            data = zlib.compress(json.dumps(names).encode("utf-8"))
+            cursor.execute("INSERT OR REPLACE INTO directory_buckets (bucket, seed, blob) VALUES (?, ?, ?);",
+                           (bucket, seed, self._directory_cipher(seed).encrypt(pad(data, 16))))
+        cursor.execute("UPDATE seeds SET directory_generation = generation;")
 
     def get_service(self, idx: int) -> Optional[Service]:
         """Get decrypted service and its recipe"""
-        services = self.get_services()
-        return next((service for service in services if service.idx == idx), None)
+        if idx in self._services or self._all_cached:
+            return self._services.get(idx)
+        row = self._fetch_one(
+            "SELECT idx, e_name, e_password, seed_name, seed_password FROM services WHERE idx = ?;", (idx,)
+        )
+        if not row:
+            return None
+        return self._services.setdefault(idx, self._decrypt_row(row))
 
-    def add_service(self, name: str, password: str) -> bool:
-        """Encrypt a service and add it to the database."""
-        if not name or not password:
-            return False
+    def get_services_by_ids(self, ids: Iterable[int]) -> List[Service]:
+        """Get decrypted services with the given ids. Unknown ids are skipped."""
+        ids = set(ids)
+        with self._cache_lock:
+            ans: List[Service] = [self._services[idx] for idx in ids if idx in self._services]
+            missing = [] if self._all_cached else [idx for idx in ids if idx not in self._services]
+        for row in self._select_ids(
+            "SELECT idx, e_name, e_password, seed_name, seed_password FROM services WHERE idx IN ({ids});", missing
+        ):
+            ans.append(self._services.setdefault(row[0], self._decrypt_row(row)))
+        ans.sort(key=lambda service: service.idx)
+        return ans
+
+    def get_service_ids(self, after_idx: int = 0, limit: int = -1) -> List[int]:
+        """Ids of the services following `after_idx` in order, nothing gets decrypted. Negative limit means all."""
+        return [row[0] for row in self._fetch_all(
+            "SELECT idx FROM services WHERE idx > ? ORDER BY idx LIMIT ?;", (after_idx, limit)
+        )]
+
+    def get_services_page(self, after_idx: int, limit: int) -> List[Service]:
+        """Decrypts up to `limit` services following `after_idx`. Meant for views keeping their own bounded cache,
+        so the services are not put into the session cache."""
+        ans: List[Service] = []
+        names = self._directory_names()
+        for row in self._fetch_all(
+            "SELECT idx, e_name, e_password, seed_name, seed_password FROM services WHERE idx > ? ORDER BY idx"
+            " LIMIT ?;", (after_idx, limit)
+        ):
+            service = self._services.get(row[0])
+            if not service and names and row[0] in names:
+                service = Service(row[0], names[row[0]], row[2], row[3], row[4], self)
+            ans.append(service or self._decrypt_row(row))
+        return ans
+
+    def cache_service(self, service: Service) -> None:
+        """Puts a freshly written service into the session cache and the search index."""
+        with self._cache_lock:
+            self._services[service.idx] = service
+            if self.name_index:
+                self.name_index.add(service.idx, service.name)
+            if self._directory is not None:
+                self._directory[service.idx] = service.name
+                self._touch_directory([service.idx])
+
+    def _forget(self, idx: int) -> None:
+        """Drops a removed service from the session cache and the search index."""
+        with self._cache_lock:
+            self._services.pop(idx, None)
+            if self.name_index:
+                self.name_index.remove(idx)
+            if self._directory is not None and idx in self._directory:
+                del self._directory[idx]
+                self._touch_directory([idx])
+
+    def _drop_cache(self) -> None:
+        with self._cache_lock:
+            self._services = {}
+            self._all_cached = False
+            self.name_index = None
+            self._directory = None
+            self._directory_checked = False
+            self._directory_buckets = set()
+            self._directory_dirty = False
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Service]:
+        """Services whose names match `query`, best first. The first search of the session decrypts all names."""
+        if self.name_index is None:
+            self.get_services()
+            with self._cache_lock:
+                if self.name_index is None:
+                    index = NameIndex()
+                    for service in self._services.values():
+                        index.add(service.idx, service.name)
+                    self.name_index = index
+        with self._cache_lock:
+            return [self._services[idx] for idx in self.name_index.search(query, limit) if idx in self._services]
+
+    def refresh(self) -> bool:
+        """Brings the session cache up to date with the services changed by others. Long-running sessions call this
+        before serving a request. Returns whether anything changed."""
+        return self.poll_changes() != set()
+
+    def poll_changes(self) -> Optional[Set[int]]:
+        """Reloads the services changed since the last call by another process, or another `Persistence` of this
+        one. Returns their ids, or None when the change log was trimmed meanwhile and the whole session cache had
+        to be dropped. Costs a single pragma when nothing was committed."""
+        with self.pool.write_lock:
+            version = self.pool.data_version()
+            if version == self._data_version:
+                return set()
+            self._data_version = version
+            rows = self._fetch_all("SELECT seq, idx FROM changes WHERE seq > ? ORDER BY seq;", (self._last_change,))
+            if not rows:
+                return set()
+            complete = rows[0][0] == self._last_change + 1
+            self._last_change = rows[-1][0]
+            if not complete:
+                self._drop_cache()
+                return None
+            changed = {row[1] for row in rows}
+            self._reload(changed)
+        return changed
+
+    def _reload(self, ids: Set[int]) -> None:
+        """Replaces the session's copies of the given services with what is stored now."""
+        found: Dict[int, Service] = {}
+        for row in self._select_ids(
+            "SELECT idx, e_name, e_password, seed_name, seed_password FROM services WHERE idx IN ({ids});",
+            ids if self.token else ()
+        ):
+            try:
+                found[row[0]] = self._decrypt_row(row)
+            except ValueError:
+                # Written by somebody without the token, `audit` reports it. It must not block our writes.
+                continue
+        with self._cache_lock:
+            for idx in ids:
+                service = found.get(idx)
+                if service is None:
+                    self._services.pop(idx, None)
+                    if self.name_index:
+                        self.name_index.remove(idx)
+                    if self._directory is not None:
+                        self._directory.pop(idx, None)
+                    continue
+                self._services[idx] = service
+                if self.name_index:
+                    self.name_index.add(idx, service.name)
+                if self._directory is not None:
+                    self._directory[idx] = service.name
+            # Writers of older versions do not update the directory, the buckets are written with our next
+            # transaction.
+            self._touch_directory(ids)
+
+    def lock(self) -> None:
+        """Forgets the token and everything decrypted with it."""
+        self._drop_cache()
+        self.token = None
+
+    def encrypt_service(self, name: str, password: str) -> EncryptedService:
+        """Encrypt a new service under fresh seeds, without storing it."""
         seed_name = rand_bytes(32)
         noise_source = sha3_384()
         noise_source.update(self.token)
@@ -180,54 +698,234 @@ class Persistence:
         digest = noise_source.digest()
         cipher_p = AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
         e_password = cipher_p.encrypt(pad(bytes(password, encoding='utf-8'), 16))
-        encrypted_service = EncryptedService(None, e_name, e_password, seed_name, seed_password, self)
-        return encrypted_service.save()
-
-    def init_token(self, user_password: str) -> None:
-        """Initiates the password decryption token. Combines main password with salt and hashes this mess many times."""
-        h = sha3_256()
-        h.update(self.seed + bytes(user_password, encoding="utf-8"))
-        digest = None
-        iterations = self.cursor.execute("SELECT iterations FROM seeds;").fetchone()[0]
-        for i in range(iterations):
-            digest = h.digest()
-            h.update(digest)
+        return EncryptedService(None, e_name, e_password, seed_name, seed_password, self, self.blind_index(name))
+
+    def add_service(self, name: str, password: str, policy: Optional[int] = None) -> Optional[Service]:
+        """Encrypt a service and add it to the database. `policy` is the idx of the policy that generated the
+        password. The name is checked to be free in the same transaction, so processes adding the same name at
+        once cannot both store it."""
+        if not name or not password:
+            return None
+        encrypted_service = self.encrypt_service(name, password)
+        encrypted_service.policy = policy
+        with self.transaction() as cursor:
+            if cursor.execute("SELECT 1 FROM services WHERE name_hmac = ? LIMIT 1;",
+                              (encrypted_service.name_hmac,)).fetchone():
+                raise ValueError(f"Service {name} already exists!")
+            encrypted_service.save()
+            service = Service(encrypted_service.idx, name, encrypted_service.e_password,
+                              encrypted_service.seed_name, encrypted_service.seed_password, self)
+            self.cache_service(service)
+        return service
+
+    def add_services(self, services: Iterable[Tuple[str, str]], batch_size: int = import_batch_size,
+                     progress: Optional[Callable[[int], None]] = None) -> int:
+        """Encrypt `(name, password)` pairs in batches and insert them all in a single transaction.
+        `progress` gets the number of services stored so far after every batch. Returns the number of services."""
+        done = 0
+        batch: List[EncryptedService] = []
+        names: List[str] = []
+        with self.transaction() as cursor:
+            for name, password in services:
+                batch.append(self.encrypt_service(name, password))
+                names.append(name)
+                if len(batch) >= batch_size:
+                    done += self._insert_services(cursor, batch, names)
+                    batch, names = [], []
+                    if progress:
+                        progress(done)
+            if batch:
+                done += self._insert_services(cursor, batch, names)
+                if progress:
+                    progress(done)
+        # The new services are not decrypted yet, next listing and search have to read them.
+        with self._cache_lock:
+            self._all_cached = False
+            self.name_index = None
+        return done
+
+    def save_policy(self, name: str, length: int, lowercase: int, uppercase: int, numbers: int, specials: int,
+                    specials_to_use: str) -> int:
+        """Creates or overwrites the policy called `name` and marks it as the last used one. Returns its idx."""
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO policies (name, length, lowercase, uppercase, numbers, specials, specials_to_use, used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET length = excluded.length,"
+                " lowercase = excluded.lowercase, uppercase = excluded.uppercase, numbers = excluded.numbers,"
+                " specials = excluded.specials, specials_to_use = excluded.specials_to_use, used = excluded.used;",
+                (name, length, lowercase, uppercase, numbers, specials, specials_to_use, time.time())
+            )
+            return cursor.execute("SELECT idx FROM policies WHERE name = ?;", (name,)).fetchone()[0]
+
+    def get_policies(self) -> List[tuple]:
+        """Rows of all policies as `(idx, name, length, lowercase, uppercase, numbers, specials, specials_to_use)`,
+        the last used first."""
+        return self._fetch_all(
+            "SELECT idx, name, length, lowercase, uppercase, numbers, specials, specials_to_use FROM policies"
+            " ORDER BY used DESC;"
+        )
+
+    def get_policy_service_ids(self, name: str) -> List[int]:
+        """Ids of the services generated by the policy called `name`."""
+        return [row[0] for row in self._fetch_all(
+            "SELECT services.idx FROM services JOIN policies ON services.policy = policies.idx"
+            " WHERE policies.name = ? ORDER BY services.idx;", (name,)
+        )]
+
+    def update_passwords(self, passwords: Dict[int, str]) -> int:
+        """Replaces the passwords of several services in one transaction. Every password is encrypted under a fresh
+        seed. Returns the number of updated services."""
+        rows = []
+        for service in self.get_services_by_ids(passwords):
+            seed_password = rand_bytes(32)
+            noise_source = sha3_384()
+            noise_source.update(self.token)
+            noise_source.update(seed_password)
+            digest = noise_source.digest()
+            cipher = AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
+            rows.append((cipher.encrypt(pad(bytes(passwords[service.idx], encoding='utf-8'), 16)), seed_password,
+                         service))
+        with self.transaction() as cursor:
+            cursor.executemany("UPDATE services SET e_password = ?, seed_password = ? WHERE idx = ?;",
+                               ((row[0], row[1], row[2].idx) for row in rows))
+            for e_password, seed_password, service in rows:
+                service.encrypted_password = e_password
+                service.seed_password = seed_password
+            with self._cache_lock:
+                if self._directory is not None:
+                    # The names did not change, only the generation the directory is stamped with.
+                    self._directory_dirty = True
+        return len(rows)
+
+    def export_chunks(self, export_password: str, chunk_size: int = export_chunk_size) -> Iterator[bytes]:
+        """Re-encrypts the whole vault under a key derived from `export_password` and yields it as the chunks of a
+        backup (see `src.backup`). Rows are fetched in small batches and not cached, so memory stays flat."""
+        writer = backup.BackupWriter(export_password, chunk_size=chunk_size)
+        yield writer.header
+        # One read transaction, the backup is a consistent snapshot even if others write meanwhile.
+        with self.pool.reader() as connection:
+            cursor = connection.execute("SELECT idx, e_name, e_password, seed_name, seed_password FROM services"
+                                        " ORDER BY idx;")
+            rows = cursor.fetchmany(export_fetch_size)
+            while rows:
+                for row in rows:
+                    service = self._decrypt_row(row)
+                    yield from writer.add(service.name, service.password)
+                rows = cursor.fetchmany(export_fetch_size)
+            cursor.close()
+        yield writer.finish()
+
+    def export_services(self, stream: IO[bytes], export_password: str) -> None:
+        """Writes an encrypted backup of the vault into a binary stream."""
+        for chunk in self.export_chunks(export_password):
+            stream.write(chunk)
+
+    def _insert_services(self, cursor: sqlite3.Cursor, batch: List[EncryptedService], names: List[str]) -> int:
+        last_idx = cursor.execute("SELECT COALESCE(MAX(idx), 0) FROM services;").fetchone()[0]
+        cursor.executemany(
+            "INSERT INTO services (e_name, e_password, seed_name, seed_password, name_hmac) VALUES (?, ?, ?, ?, ?);",
+            ((s.e_name, s.e_password, s.seed_name, s.seed_password, s.name_hmac) for s in batch)
+        )
+        with self._cache_lock:
+            if self._directory is not None:
+                # Nobody else can write during our transaction, so the new rows got increasing ids in our order.
+                ids = self.get_service_ids(last_idx)
+                self._directory.update(zip(ids, names))
+                self._touch_directory(ids)
+        return len(batch)
+
+    @property
+    def key_derivation(self) -> kdf.KDF:
+        """Key derivation function this vault was created with."""
+        iterations, algorithm, params = self._fetch_one("SELECT iterations, algorithm, params FROM seeds;")
+        return kdf.load(algorithm, params, iterations)
+
+    @staticmethod
+    def _wrapping_cipher(key: bytes):
+        """Cipher protecting the vault token with the key derived from the main password."""
+        noise_source = sha3_384()
+        noise_source.update(key)
+        digest = noise_source.digest()
+        return AES.new(digest[:32], AES.MODE_CBC, iv=digest[32:])
+
+    def init_token(self, user_password: str, progress: Optional[kdf.Progress] = None,
+                   run_kdf: Optional[kdf.Runner] = None) -> None:
+        """Initiates the password decryption token."""
+        self.token = self._derive_token(user_password, progress, run_kdf)
+
+    def _derive_token(self, user_password: str, progress: Optional[kdf.Progress] = None,
+                      run_kdf: Optional[kdf.Runner] = None) -> bytes:
+        """Combines main password with salt using the vault's KDF. Vaults with a wrapped token use the result only
+        to unwrap the real token."""
+        digest = kdf.run(self.key_derivation, user_password, self.seed, progress, run_kdf)
+        control_hash, wrapped_token = self._fetch_one("SELECT controlhash, wrapped_token FROM seeds;")
+        if wrapped_token:
+            try:
+                digest = unpad(self._wrapping_cipher(digest).decrypt(wrapped_token), 16)
+            except ValueError:
+                raise ValueError("Incorrect password!")
         h2 = sha3_512()
         h2.update(digest)
-        control_hash = self.cursor.execute("SELECT controlhash FROM seeds;").fetchone()[
-            0
-        ]
         if control_hash != h2.digest():
             raise ValueError("Incorrect password!")
-        self.token = digest
+        return digest
 
-    def set_password(self, user_password: str) -> None:
-        """Initiates salt used for the database encryption."""
+    def set_password(self, user_password: str, derivation: kdf.KDF = None,
+                     progress: Optional[kdf.Progress] = None, run_kdf: Optional[kdf.Runner] = None) -> None:
+        """Initiates salt used for the database encryption and a random token wrapped by the main password."""
         if seed_length < 1:
             raise ValueError(
                 "There has to be at least some cryptographic salt!"
                 " src.config.seed_length must be grater than 0!"
             )
-        if auth_iterations < 1:
-            raise ValueError("Cannot perform less than 1 iteration!")
-        h = sha3_256()
+        if derivation is None:
+            derivation = kdf.calibrate() if calibrate_kdf else kdf.default()
         seed = rand_bytes(seed_length)
-        h.update(seed + bytes(user_password, encoding="utf-8"))
-        digest = None
-        for i in range(auth_iterations):
-            digest = h.digest()
-            h.update(digest)
+        token = rand_bytes(kdf.token_length)
+        key = kdf.run(derivation, user_password, seed, progress, run_kdf)
+        wrapped_token = self._wrapping_cipher(key).encrypt(pad(token, 16))
         h2 = sha3_512()
-        h2.update(digest)
-        self.cursor.execute(
-            "INSERT INTO seeds VALUES (?, ?, ?);", (seed, auth_iterations, h2.digest())
-        )
-        self.conn.commit()
+        h2.update(token)
+        with self.transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO seeds (seed, iterations, controlhash, algorithm, params, wrapped_token)"
+                " VALUES (?, ?, ?, ?, ?, ?);",
+                (seed, derivation.params.get("iterations"), h2.digest(), derivation.algorithm, derivation.dumps(),
+                 wrapped_token)
+            )
+        self.token = token
+
+    def retune(self, user_password: str, derivation: kdf.KDF = None) -> kdf.KDF:
+        """Changes the KDF of the vault, by default to the cost calibrated for this machine. Only the token is
+        re-wrapped under a fresh salt, the services stay encrypted as they are."""
+        if self._derive_token(user_password) != self.token:
+            raise ValueError("Incorrect password!")
+        if derivation is None:
+            derivation = kdf.calibrate()
+        seed = rand_bytes(seed_length)
+        wrapped_token = self._wrapping_cipher(derivation.derive(user_password, seed)).encrypt(pad(self.token, 16))
+        with self.transaction() as cursor:
+            cursor.execute(
+                "UPDATE seeds SET seed = ?, iterations = ?, algorithm = ?, params = ?, wrapped_token = ?;",
+                (seed, derivation.params.get("iterations"), derivation.algorithm, derivation.dumps(), wrapped_token)
+            )
+        return derivation
 
     def remove_service(self, service: Service) -> bool:
         """Removes a service."""
         if not service:
             return False
-        self.cursor.execute("DELETE FROM services WHERE idx=?;", (service.idx,))
-        self.conn.commit()
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM services WHERE idx=?;", (service.idx,))
+            self._forget(service.idx)
         return True
+
+    def remove_services(self, ids: Iterable[int]) -> Dict[int, bool]:
+        """Removes several services in one transaction. Tells for every id whether it was found."""
+        ids = list(set(ids))
+        with self.transaction() as cursor:
+            found = {row[0] for row in self._select_ids("SELECT idx FROM services WHERE idx IN ({ids});", ids, cursor)}
+            self._select_ids("DELETE FROM services WHERE idx IN ({ids});", ids, cursor)
+            for idx in found:
+                self._forget(idx)
+        return {idx: idx in found for idx in ids}
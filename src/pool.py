@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, TypeVar
+
+from src.config import journal_mode, synchronous, busy_timeout, pool_readers, lock_timeout
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+T = TypeVar("T")
+
+
+def _backoff(deadline: float, delay: float) -> float:
+    """Sleeps before the next attempt and returns the following delay, raises when the deadline passed."""
+    if time.monotonic() + delay > deadline:
+        raise ValueError("Vault is busy in another process!")
+    time.sleep(delay)
+    return min(delay * 2, 0.25)
+
+
+def is_busy(error: sqlite3.Error) -> bool:
+    """Whether the error only means that another connection holds a lock."""
+    return isinstance(error, sqlite3.OperationalError) and "is locked" in str(error)
+
+
+def retry(function: Callable[[], T], timeout: float = lock_timeout) -> T:
+    """Calls `function` until it does not fail with `database is locked`, waiting longer after every failure."""
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        try:
+            return function()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+            delay = _backoff(deadline, delay)
+
+
+class FileLock:
+    """Advisory lock on a file, held by one process at a time. Other processes that try to take it wait, the
+    operating system releases it when its holder dies."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self, timeout: float = lock_timeout) -> None:
+        self._file = open(self.path, "a+b")
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    self._file.seek(0)
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                try:
+                    delay = _backoff(deadline, delay)
+                except ValueError:
+                    self._file.close()
+                    self._file = None
+                    raise
+
+    def release(self) -> None:
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+class ConnectionPool:
+    """Connections to one SQLite database: a single writer and up to `readers` read-only connections, opened on
+    demand. In WAL mode the readers run in parallel with each other and with the writer, writes are serialized by
+    the write lock, and between processes by an advisory lock on the file `<database>.lock`. A thread inside
+    a write transaction reads through the writer, so it sees its own changes."""
+
+    def __init__(self, path: Path, readers: int = pool_readers):
+        if readers < 1:
+            raise ValueError("There has to be at least 1 reader!")
+        self.path = Path(path)
+        self.file_lock = FileLock(self.path.with_name(self.path.name + ".lock"))
+        self.writer = self._connect(read_only=False)
+        self.write_lock = threading.RLock()
+        self.writing_thread = None
+        self.max_readers = readers
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._opened: List[sqlite3.Connection] = []
+        self._open_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        # Transactions are handled explicitly, so the implicit ones of the sqlite3 module are turned off.
+        if read_only:
+            connection = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True,
+                                         check_same_thread=False, isolation_level=None)
+            connection.execute(f"PRAGMA busy_timeout = {busy_timeout};")
+        else:
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # Switching the journal mode needs a lock, so another process may make us wait.
+            connection.execute(f"PRAGMA busy_timeout = {busy_timeout};")
+            retry(lambda: connection.execute(f"PRAGMA journal_mode = {journal_mode};"))
+            connection.execute(f"PRAGMA synchronous = {synchronous};")
+        return connection
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Borrows a read-only connection. Nested calls of one thread get the same connection."""
+        if self.writing_thread == threading.get_ident():
+            yield self.writer
+            return
+        held = getattr(self._local, "connection", None)
+        if held is not None:
+            yield held
+            return
+        connection = self._acquire()
+        self._local.connection = connection
+        try:
+            yield connection
+        finally:
+            self._local.connection = None
+            self._idle.put(connection)
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._open_lock:
+            if len(self._opened) < self.max_readers:
+                connection = self._connect(read_only=True)
+                self._opened.append(connection)
+                return connection
+        return self._idle.get()
+
+    @contextmanager
+    def writing(self, wait: bool = True) -> Iterator[sqlite3.Connection]:
+        """Holds the write locks of the thread and the process, the caller runs its transaction on the yielded writer
+        connection. Without `wait`, raises `ValueError` at once when another writer holds them."""
+        if not self.write_lock.acquire(blocking=wait):
+            raise ValueError("Vault is busy!")
+        try:
+            outer = self.writing_thread
+            if outer is None:
+                self.file_lock.acquire(lock_timeout if wait else 0)
+            self.writing_thread = threading.get_ident()
+            try:
+                yield self.writer
+            finally:
+                self.writing_thread = outer
+                if outer is None:
+                    self.file_lock.release()
+        finally:
+            self.write_lock.release()
+
+    def data_version(self) -> int:
+        """Changes whenever another connection, possibly of another process, commits to the database."""
+        with self.write_lock:
+            return retry(lambda: self.writer.execute("PRAGMA data_version;").fetchone()[0])
+
+    def close(self) -> None:
+        with self._open_lock:
+            for connection in self._opened:
+                connection.close()
+            self._opened.clear()
+        self.writer.close()
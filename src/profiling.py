@@ -0,0 +1,101 @@
+"""Startup profiling of the GUI, run `python main.py --profile-startup`. Reports how long every module takes to import,
+how long the main objects take to construct and the time until the login window is shown."""
+from __future__ import annotations
+
+import json
+import sys
+import time
+from importlib.machinery import ExtensionFileLoader, SourceFileLoader, SourcelessFileLoader
+from typing import Callable, List, Tuple
+
+# Python modules run in `exec_module`, extension modules are loaded and initialized in `create_module`.
+loaders = ((SourceFileLoader, "exec_module"), (SourcelessFileLoader, "exec_module"),
+           (ExtensionFileLoader, "create_module"))
+
+
+class ImportProfile:
+    """Times the execution of every module imported inside the `with` block. `modules` holds
+    `(name, cumulative seconds, self seconds)`, where self time excludes the imports the module triggered."""
+
+    def __init__(self):
+        self.modules: List[Tuple[str, float, float]] = []
+        self._children: List[float] = []
+        self._originals = {}
+
+    def __enter__(self) -> ImportProfile:
+        for loader, method in loaders:
+            self._originals[loader, method] = loader.__dict__.get(method)
+            setattr(loader, method, self._timed(getattr(loader, method)))
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for (loader, method), original in self._originals.items():
+            if original is None:
+                delattr(loader, method)
+            else:
+                setattr(loader, method, original)
+
+    def _timed(self, load: Callable) -> Callable:
+        def timed_load(loader, target):
+            self._children.append(0.0)
+            start = time.perf_counter()
+            try:
+                return load(loader, target)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = self._children.pop()
+                if self._children:
+                    self._children[-1] += elapsed
+                # `exec_module` gets the module, `create_module` its spec.
+                name = getattr(target, "__name__", None) or target.name
+                self.modules.append((name, elapsed, elapsed - children))
+        return timed_load
+
+
+def profile_startup(json_output: bool = False, top: int = 20) -> float:
+    """Starts the GUI up to the login window, prints where the time went and quits. Returns the milliseconds until
+    the login window was shown. Interpreter startup before this function is not included."""
+    start = time.perf_counter()
+    phases: List[Tuple[str, float]] = []
+
+    def phase(name: str, since: float) -> float:
+        now = time.perf_counter()
+        phases.append((name, (now - since) * 1000))
+        return now
+
+    with ImportProfile() as imports:
+        now = start
+        from PyQt5 import QtWidgets
+        now = phase("import PyQt5.QtWidgets", now)
+        import src.app as app
+        now = phase("import src.app", now)
+        application = QtWidgets.QApplication(sys.argv[:1])
+        application.setFont(app.QFont("Helvetica", 10))
+        now = phase("QApplication", now)
+        window = app.MainWindow()
+        now = phase("MainWindow with LoginDialog", now)
+        application.processEvents()
+        phase("first events and paint", now)
+    login_window = (time.perf_counter() - start) * 1000
+    if not window.login_dialog.isVisible():
+        raise RuntimeError("Login window was not shown!")
+    slowest = sorted(imports.modules, key=lambda module: module[2], reverse=True)[:top]
+    if json_output:
+        print(json.dumps({
+            "login_window_ms": login_window,
+            "phases": [{"phase": name, "ms": ms} for name, ms in phases],
+            "imports": [{"module": name, "cumulative_ms": cumulative * 1000, "self_ms": own * 1000}
+                        for name, cumulative, own in slowest],
+            "imported_modules": len(imports.modules),
+        }, indent=2))
+    else:
+        print(f"{'phase':<40}{'ms':>10}")
+        for name, ms in phases:
+            print(f"{name:<40}{ms:>10.1f}")
+        print(f"\n{len(imports.modules)} modules imported, the slowest ones:")
+        print(f"{'module':<40}{'self ms':>10}{'total ms':>10}")
+        for name, cumulative, own in slowest:
+            print(f"{name:<40}{own * 1000:>10.1f}{cumulative * 1000:>10.1f}")
+        print(f"\nTime to login window: {login_window:.1f} ms")
+    window.login_dialog.hide()
+    return login_window
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import heapq
+import math
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+import src.config as config
+from src.utils import normalize_name
+
+
+class NameIndex:
+    """In-memory trigram index over decrypted service names. Names are padded with two spaces in front, so the first
+    trigrams of a word double as its prefix index and even one or two typed letters find something."""
+
+    def __init__(self):
+        self.names: Dict[int, str] = {}
+        self.grams: Dict[str, Set[int]] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return normalize_name(text)
+
+    @staticmethod
+    def trigrams(text: str) -> Set[str]:
+        padded = "  " + text.replace(" ", "  ")
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, idx: int, name: str) -> None:
+        """Indexes a new service, or re-indexes a renamed one."""
+        self.remove(idx)
+        name = self.normalize(name)
+        self.names[idx] = name
+        for gram in self.trigrams(name):
+            self.grams.setdefault(gram, set()).add(idx)
+
+    def remove(self, idx: int) -> None:
+        name = self.names.pop(idx, None)
+        if name is None:
+            return
+        for gram in self.trigrams(name):
+            postings = self.grams[gram]
+            postings.discard(idx)
+            if not postings:
+                del self.grams[gram]
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """Ids of the services matching `query`, best first. A name scores by the share of the query's trigrams it
+        contains, with a bonus for containing the query and another for starting with it, so typos still match.
+        Queries shorter than a trigram only match word prefixes."""
+        query = self.normalize(query)
+        if not query:
+            return []
+        if len(query) < 3:
+            grams = self.trigrams(query)
+            needed = len(grams)
+        else:
+            grams = {query[i:i + 3] for i in range(len(query) - 2)}
+            needed = math.ceil(config.search_min_similarity * len(grams))
+        counts: Counter = Counter()
+        for gram in grams:
+            counts.update(self.grams.get(gram, ()))
+        scored = []
+        for idx, shared in counts.items():
+            if shared < needed:
+                continue
+            score = shared / len(grams)
+            name = self.names[idx]
+            if query in name:
+                score += 1
+                if name.startswith(query):
+                    score += 1
+            scored.append((-score, len(name), idx))
+        if limit is None:
+            scored.sort()
+        else:
+            scored = heapq.nsmallest(limit, scored)
+        return [idx for _, _, idx in scored]
@@ -32,6 +32,13 @@ class Ui_Dialog(object):
         self.lineEditName = QtWidgets.QLineEdit(Dialog)
         self.lineEditName.setObjectName("lineEditName")
         self.gridLayout.addWidget(self.lineEditName, 0, 1, 1, 1)
+        self.label_8 = QtWidgets.QLabel(Dialog)
+        self.label_8.setObjectName("label_8")
+        self.gridLayout.addWidget(self.label_8, 2, 0, 1, 1)
+        self.comboBoxPolicy = QtWidgets.QComboBox(Dialog)
+        self.comboBoxPolicy.setEditable(True)
+        self.comboBoxPolicy.setObjectName("comboBoxPolicy")
+        self.gridLayout.addWidget(self.comboBoxPolicy, 2, 1, 1, 1)
         self.verticalLayout.addLayout(self.gridLayout)
         self.gridLayout_2 = QtWidgets.QGridLayout()
         self.gridLayout_2.setObjectName("gridLayout_2")
@@ -107,6 +114,7 @@ class Ui_Dialog(object):
         self.label_7.setText(_translate("Dialog", "Service name:"))
         self.label_6.setText(_translate("Dialog", "Length:"))
         self.lineEditLength.setPlaceholderText(_translate("Dialog", "16"))
+        self.label_8.setText(_translate("Dialog", "Policy:"))
         self.checkBoxEnforceLowercase.setText(_translate("Dialog", "Enforce"))
         self.checkBoxAllowLowercase.setText(_translate("Dialog", "Allow"))
         self.checkBoxEnforceNumbers.setText(_translate("Dialog", "Enforce"))
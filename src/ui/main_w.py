@@ -19,6 +19,10 @@ class Ui_MainWindow(object):
         self.centralwidget.setObjectName("centralwidget")
         self.verticalLayout_3 = QtWidgets.QVBoxLayout(self.centralwidget)
         self.verticalLayout_3.setObjectName("verticalLayout_3")
+        self.lineEditSearch = QtWidgets.QLineEdit(self.centralwidget)
+        self.lineEditSearch.setClearButtonEnabled(True)
+        self.lineEditSearch.setObjectName("lineEditSearch")
+        self.verticalLayout_3.addWidget(self.lineEditSearch)
         self.tableView = QtWidgets.QTableView(self.centralwidget)
         self.tableView.setContextMenuPolicy(QtCore.Qt.ActionsContextMenu)
         self.tableView.setObjectName("tableView")
@@ -43,6 +47,7 @@ class Ui_MainWindow(object):
     def retranslateUi(self, MainWindow):
         _translate = QtCore.QCoreApplication.translate
         MainWindow.setWindowTitle(_translate("MainWindow", "MainWindow"))
+        self.lineEditSearch.setPlaceholderText(_translate("MainWindow", "Search"))
         self.generate_password.setText(_translate("MainWindow", "Generate new"))
         self.store_password.setText(_translate("MainWindow", "Store password"))
         self.actionDelete.setText(_translate("MainWindow", "Delete"))
@@ -1,8 +1,8 @@
 from __future__ import annotations
 import secrets
+import unicodedata
 from pathlib import Path
-from typing import Generator
-from hashlib import md5
+from typing import Optional, Union
 import src.config as config
 
 
@@ -13,30 +13,62 @@ def rand_bytes(num: int) -> bytes:
     return secrets.token_bytes(num)
 
 
+def normalize_name(name: str) -> str:
+    """Canonical form of a service name, so that `GitHub` and ` github ` are the same service."""
+    return " ".join(unicodedata.normalize("NFKC", name).casefold().split())
+
+
 def get_project_root() -> Path:
     """Returns project's root directory."""
     return Path(__file__).parent.parent
 
 
-# TODO: make more secure, now it will just generate 512 unique symbols before looping
-def byte_cycling(b: bytes) -> Generator[int, None, None]:
-    """Creates a generator that will cycle infinitely through input bytes."""
-    while True:
-        for byte in b:
-            yield byte
+def vault_path(path: Optional[Union[str, Path]] = None) -> Path:
+    """Path of a vault, by default the `db_name` file in the project root."""
+    if path:
+        return Path(path).expanduser()
+    return get_project_root() / (config.db_name or "pswdmngr.db")
+
+
+class RandomBuffer:
+    """Reads the operating system's CSPRNG in large blocks and turns the bytes into unbiased random numbers."""
+
+    def __init__(self, block_size: int = config.random_block_size):
+        if block_size < 1:
+            raise ValueError("Cannot buffer less than 1 byte!")
+        self.block_size = block_size
+        self.buffer = b""
+        self.position = 0
+
+    def read(self, num: int) -> bytes:
+        """Returns `num` fresh random bytes, every byte is used only once."""
+        if self.position + num > len(self.buffer):
+            self.buffer = self.buffer[self.position:] + rand_bytes(max(self.block_size, num))
+            self.position = 0
+        data = self.buffer[self.position:self.position + num]
+        self.position += num
+        return data
 
+    def randbelow(self, bound: int) -> int:
+        """Uniform integer from [0, bound). Values from the incomplete last range are rejected instead of being
+        folded by modulo, which would favour the low numbers."""
+        if bound < 1:
+            raise ValueError("Upper bound must be positive!")
+        size = ((bound - 1).bit_length() + 7) // 8 or 1
+        space = 1 << (8 * size)
+        limit = space - space % bound
+        while True:
+            value = int.from_bytes(self.read(size), "big")
+            if value < limit:
+                return value % bound
 
-def hash_db() -> bytes:
-    """Returns hash of the .db file."""
-    h = md5()
-    with open(get_project_root() / config.db_name, "rb") as db_file:
-        data = db_file.read(65536)
-        while data:
-            h.update(data)
-            data = db_file.read(65536)
-    return h.digest()
+    def shuffle(self, items: list) -> None:
+        """Fisher-Yates shuffle in place, every permutation is equally likely."""
+        for i in range(len(items) - 1, 0, -1):
+            j = self.randbelow(i + 1)
+            items[i], items[j] = items[j], items[i]
 
 
-def is_first_init() -> bool:
+def is_first_init(path: Optional[Union[str, Path]] = None) -> bool:
     """Determines if the user has already created a profile."""
-    return not (get_project_root() / config.db_name).is_file()
+    return not vault_path(path).is_file()
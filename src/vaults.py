@@ -0,0 +1,86 @@
+"""Several vaults unlocked at the same time, each under its own name, like one vault per environment."""
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import src.persistence as persistence
+from src.interface import PasswordManager
+
+VaultPath = Union[str, Path]
+
+
+class VaultRegistry:
+    """Unlocked vaults by name. `unlock` opens several at once, their key derivations run in parallel on a pool of
+    processes, so they neither wait for each other nor for the interpreter lock."""
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes or os.cpu_count() or 1
+        self.vaults: Dict[str, PasswordManager] = {}
+
+    def __getitem__(self, name: str) -> PasswordManager:
+        if name not in self.vaults:
+            raise ValueError(f"Vault {name} is not unlocked!")
+        return self.vaults[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.vaults
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.vaults)
+
+    def __len__(self) -> int:
+        return len(self.vaults)
+
+    def __enter__(self) -> VaultRegistry:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.lock_all()
+
+    def open(self, name: str, path: VaultPath, user_password: str) -> PasswordManager:
+        """Unlocks a single vault in this process, creating it if it does not exist."""
+        self._check_free(name)
+        self.vaults[name] = PasswordManager(user_password, path=path)
+        return self.vaults[name]
+
+    def unlock(self, vaults: Dict[str, Tuple[VaultPath, str]]) -> Dict[str, str]:
+        """Unlocks vaults given as `{name: (path, main password)}`, creating the ones that do not exist. Returns the
+        error of every vault that could not be unlocked, the others are available under their names."""
+        for name in vaults:
+            self._check_free(name)
+        if not vaults:
+            return {}
+        errors: Dict[str, str] = {}
+        with ProcessPoolExecutor(min(self.processes, len(vaults))) as processes, \
+                ThreadPoolExecutor(len(vaults)) as threads:
+
+            def open_vault(path: VaultPath, user_password: str) -> PasswordManager:
+                # The thread only waits for its derivation, the database stays in this process.
+                vault = persistence.Persistence(path=path)
+                vault.unlock(user_password, run_kdf=lambda job: processes.submit(job).result())
+                return PasswordManager.from_persistence(vault)
+
+            futures = {name: threads.submit(open_vault, path, user_password)
+                       for name, (path, user_password) in vaults.items()}
+            for name, future in futures.items():
+                try:
+                    self.vaults[name] = future.result()
+                except (ValueError, OSError) as e:
+                    errors[name] = str(e)
+        return errors
+
+    def _check_free(self, name: str) -> None:
+        if name in self.vaults:
+            raise ValueError(f"Vault {name} is already unlocked!")
+
+    def lock(self, name: str) -> None:
+        """Forgets the token of a vault and removes it from the registry."""
+        self[name].lock()
+        del self.vaults[name]
+
+    def lock_all(self) -> None:
+        for name in list(self.vaults):
+            self.lock(name)